@@ -0,0 +1,86 @@
+"""
+Sparse boolean matrix of species per grid cell.
+
+A matrix is a dict with the sorted int64 cell 'keys' and int64 species 'codes' of its true
+entries (one entry per unique cell/species pair) and the 'species' names the codes refer to.
+Union over neighbors, selections and counts are array operations on these pairs.
+"""
+import numpy as np
+import pandas as pd
+from .create_ha_polygon_layer import neighbor_keys
+
+def unique_pairs(keys, codes):
+    """Sort (key, code) pairs and drop duplicates."""
+    order = np.lexsort((codes, keys))
+    keys = keys[order]
+    codes = codes[order]
+    keep = np.ones(len(keys), dtype=bool)
+    keep[1:] = (keys[1:] != keys[:-1]) | (codes[1:] != codes[:-1])
+    return keys[keep], codes[keep]
+
+def make_matrix(keys, codes, species):
+    """Build a matrix from possibly duplicate (key, code) pairs."""
+    keys, codes = unique_pairs(np.asarray(keys, dtype=np.int64), np.asarray(codes, dtype=np.int64))
+    return {'keys': keys, 'codes': codes, 'species': np.asarray(species, dtype=object)}
+
+def empty_matrix():
+    """Return a matrix without cells and species."""
+    return make_matrix([], [], [])
+
+def species_matrix(keys, names):
+    """Build a matrix from (cell key, species name) observations; missing names are skipped."""
+    codes, species = pd.factorize(pd.Series(names, dtype=object))
+    keys = np.asarray(keys, dtype=np.int64)
+    observed = codes >= 0
+    return make_matrix(keys[observed], codes[observed], species)
+
+def lowercase_species(matrix):
+    """Merge species whose names only differ in case, using the lower-cased names."""
+    codes, species = pd.factorize(pd.Series(matrix['species'], dtype=object).str.lower())
+    return make_matrix(matrix['keys'], codes[matrix['codes']], species)
+
+def select_species(matrix, names):
+    """Keep only the entries of the given species names."""
+    wanted = np.array([name in names for name in matrix['species']], dtype=bool)
+    keep = wanted[matrix['codes']] if len(wanted) else np.zeros(len(matrix['codes']), dtype=bool)
+    return filter_entries(matrix, keep)
+
+def filter_entries(matrix, keep):
+    """Keep only the entries where the boolean mask is true."""
+    return {'keys': matrix['keys'][keep], 'codes': matrix['codes'][keep], 'species': matrix['species']}
+
+def spread_to_neighbors(matrix):
+    """Union of every cell with its 8 neighbors: each species is added to the 3x3 block around its cell."""
+    keys = neighbor_keys(matrix['keys']).ravel()
+    codes = np.repeat(matrix['codes'], 9)
+    return make_matrix(keys, codes, matrix['species'])
+
+def concat_matrices(matrices):
+    """Union of matrices, which may use different species codes."""
+    matrices = [matrix for matrix in matrices if len(matrix['species'])]
+    if not matrices:
+        return empty_matrix()
+    species, inverse = np.unique(
+        np.concatenate([matrix['species'] for matrix in matrices]).astype(str), return_inverse=True
+    )
+    keys = []
+    codes = []
+    offset = 0
+    for matrix in matrices:
+        remap = inverse[offset:offset + len(matrix['species'])]
+        offset += len(matrix['species'])
+        keys.append(matrix['keys'])
+        codes.append(remap[matrix['codes']])
+    return make_matrix(np.concatenate(keys), np.concatenate(codes), species.astype(object))
+
+def cell_keys_of(matrix):
+    """Return the unique cell keys with at least one species."""
+    return np.unique(matrix['keys'])
+
+def species_lists(matrix, keys):
+    """Return, for each of the given cell keys, the list of species names in that cell."""
+    keys = np.asarray(keys, dtype=np.int64)
+    starts = np.searchsorted(matrix['keys'], keys, side='left')
+    ends = np.searchsorted(matrix['keys'], keys, side='right')
+    names = matrix['species'][matrix['codes']].tolist() if len(matrix['codes']) else []
+    return [names[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
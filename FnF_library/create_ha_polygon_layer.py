@@ -1,8 +1,32 @@
 import math
-from qgis.core import QgsRectangle, QgsVectorLayer, QgsFeature, QgsGeometry, QgsField
+import re
+import numpy as np
+from qgis.core import QgsRectangle, QgsVectorLayer, QgsFeature, QgsGeometry, QgsField, QgsSpatialIndex
 from qgis.PyQt.QtCore import QVariant
+from .processing_setup import check_canceled
 
 CELL_SIZE = 100  # 100x100 meter cells
+GRID_CHUNK_SIZE = 50000  # Number of cells written to the provider per batch
+TILE_CELLS = 100  # Tiles for tiled processing are 100x100 cells (10x10 km)
+CELL_ID_PATTERN = re.compile(r'^(-?\d+)-(-?\d+)$')
+
+# Cells are keyed internally by a packed int64: column in the high 32 bits, offset row in the low 32 bits
+CELL_KEY_ROW_BITS = 32
+CELL_KEY_ROW_OFFSET = 1 << 31
+CELL_KEY_ROW_MASK = (1 << CELL_KEY_ROW_BITS) - 1
+NEIGHBOR_KEY_OFFSETS = np.array(
+    [dx * (1 << CELL_KEY_ROW_BITS) + dy for dy in (-1, 0, 1) for dx in (-1, 0, 1)],
+    dtype=np.int64,
+)
+
+# Little-endian WKB layout of a single-ring square polygon (5 vertices)
+SQUARE_WKB_DTYPE = np.dtype([
+    ('byte_order', 'u1'),
+    ('wkb_type', '<u4'),
+    ('num_rings', '<u4'),
+    ('num_points', '<u4'),
+    ('coords', '<f8', (5, 2)),
+])
 
 def get_bounding_box_from_selection(layer):
     """Get the bounding box of the selected features in the layer."""
@@ -16,36 +40,260 @@ def get_bounding_box_from_selection(layer):
     
     return extent
 
-def create_squares_from_bbox(bbox, crs="EPSG:28992"):
-    """Create a grid of square cells from a bounding box."""
-    x_min = math.floor(bbox.xMinimum() / CELL_SIZE) * CELL_SIZE - 100
-    y_min = math.floor(bbox.yMinimum() / CELL_SIZE) * CELL_SIZE - 100
-    x_max = math.ceil(bbox.xMaximum() / CELL_SIZE) * CELL_SIZE + 100
-    y_max = math.ceil(bbox.yMaximum() / CELL_SIZE) * CELL_SIZE + 100
-    
-    # Create a new vector layer for the grid
-    grid_layer = QgsVectorLayer(f"Polygon?crs={crs}", "Square Grid", "memory")
+def grid_extent(bbox):
+    """Return the cell-aligned rectangle of the grid covering a bounding box, padded by one cell."""
+    return QgsRectangle(
+        math.floor(bbox.xMinimum() / CELL_SIZE) * CELL_SIZE - 100,
+        math.floor(bbox.yMinimum() / CELL_SIZE) * CELL_SIZE - 100,
+        math.ceil(bbox.xMaximum() / CELL_SIZE) * CELL_SIZE + 100,
+        math.ceil(bbox.yMaximum() / CELL_SIZE) * CELL_SIZE + 100,
+    )
+
+def grid_cell_origins(bbox):
+    """Return the bottom-left x and y coordinates of all grid cells covering a bounding box."""
+    extent = grid_extent(bbox)
+    xs, ys = np.meshgrid(
+        np.arange(int(extent.xMinimum()), int(extent.xMaximum()), CELL_SIZE, dtype=np.int64),
+        np.arange(int(extent.yMinimum()), int(extent.yMaximum()), CELL_SIZE, dtype=np.int64),
+        indexing='ij',
+    )
+    return xs.ravel(), ys.ravel()
+
+def cell_origins_from_coordinates(xs, ys):
+    """Return the origins of the cells containing the given coordinates by floor division."""
+    cell_xs = np.floor(np.asarray(xs, dtype=np.float64) / CELL_SIZE).astype(np.int64) * CELL_SIZE
+    cell_ys = np.floor(np.asarray(ys, dtype=np.float64) / CELL_SIZE).astype(np.int64) * CELL_SIZE
+    return cell_xs, cell_ys
+
+def cell_ids(xs, ys):
+    """Render cell origins as 'x-y' id strings."""
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    return np.char.add(np.char.add(xs.astype(str), '-'), ys.astype(str)).tolist()
+
+def cell_origins_from_ids(ids):
+    """Parse 'x-y' id strings back into cell origins."""
+    origins = [CELL_ID_PATTERN.match(cell_id).groups() for cell_id in ids]
+    origins = np.array(origins, dtype=np.int64).reshape(-1, 2)
+    return origins[:, 0], origins[:, 1]
+
+def invalid_cell_ids(ids):
+    """Return the ids that are not 'x-y' origins of cells on multiples of CELL_SIZE (NULL included)."""
+    invalid = []
+    for cell_id in ids:
+        match = CELL_ID_PATTERN.match(cell_id) if isinstance(cell_id, str) else None
+        if match is None or any(int(value) % CELL_SIZE for value in match.groups()):
+            invalid.append(cell_id)
+    return invalid
+
+def check_grid_ids(grid_layer):
+    """Raise a ValueError when the grid layer has no 'id' field or ids that cannot be parsed into cell keys."""
+    id_index = grid_layer.fields().indexOf('id')
+    if id_index < 0:
+        raise ValueError(f"The grid layer '{grid_layer.name()}' has no 'id' field.")
+    invalid = invalid_cell_ids(grid_layer.uniqueValues(id_index))
+    if invalid:
+        examples = ', '.join(repr(cell_id) for cell_id in invalid[:5])
+        raise ValueError(
+            f"The grid layer '{grid_layer.name()}' has {len(invalid)} ids that are not 'x-y' origins "
+            f"of {CELL_SIZE} m cells, for example {examples}."
+        )
+
+def cell_keys(xs, ys):
+    """Pack cell origins into int64 cell keys."""
+    cols = np.asarray(xs, dtype=np.int64) // CELL_SIZE
+    rows = np.asarray(ys, dtype=np.int64) // CELL_SIZE
+    return (cols << CELL_KEY_ROW_BITS) + (rows + CELL_KEY_ROW_OFFSET)
+
+def cell_origins_from_keys(keys):
+    """Unpack int64 cell keys into cell origins."""
+    keys = np.asarray(keys, dtype=np.int64)
+    cols = keys >> CELL_KEY_ROW_BITS
+    rows = (keys & CELL_KEY_ROW_MASK) - CELL_KEY_ROW_OFFSET
+    return cols * CELL_SIZE, rows * CELL_SIZE
+
+def cell_keys_from_ids(ids):
+    """Parse 'x-y' id strings into int64 cell keys."""
+    return cell_keys(*cell_origins_from_ids(ids))
+
+def cell_ids_from_keys(keys):
+    """Render int64 cell keys as 'x-y' id strings."""
+    return cell_ids(*cell_origins_from_keys(keys))
+
+def neighbor_keys(keys):
+    """Return, per cell key, the keys of the 3x3 block of cells around it (the cell included)."""
+    keys = np.asarray(keys, dtype=np.int64)
+    return keys[:, None] + NEIGHBOR_KEY_OFFSETS[None, :]
+
+def cell_keys_in_extent(keys, extent):
+    """Return a boolean mask of the cell keys whose origin lies inside the extent."""
+    xs, ys = cell_origins_from_keys(keys)
+    return (
+        (xs >= extent.xMinimum()) & (xs < extent.xMaximum())
+        & (ys >= extent.yMinimum()) & (ys < extent.yMaximum())
+    )
+
+def tile_extents(extent, tile_cells=TILE_CELLS):
+    """Split the cells covering an extent into square tiles of tile_cells x tile_cells cells."""
+    tile_size = tile_cells * CELL_SIZE
+    x_min = math.floor(extent.xMinimum() / CELL_SIZE) * CELL_SIZE
+    y_min = math.floor(extent.yMinimum() / CELL_SIZE) * CELL_SIZE
+    x_max = math.ceil(extent.xMaximum() / CELL_SIZE) * CELL_SIZE
+    y_max = math.ceil(extent.yMaximum() / CELL_SIZE) * CELL_SIZE
+
+    tiles = []
+    for x in range(x_min, x_max, tile_size):
+        for y in range(y_min, y_max, tile_size):
+            tiles.append(QgsRectangle(x, y, min(x + tile_size, x_max), min(y + tile_size, y_max)))
+    return tiles
+
+def polygon_cell_pairs(features, buffer_distance=0, feedback=None, cell_extent=None):
+    """
+    Return the origins of all cells intersecting each polygon, together with the polygon feature id.
+    The polygons are walked in 100 m strips; a spatial index picks the polygons per strip and only
+    the cells spanned by the clipped part of each polygon are tested.
+    With a cell_extent the strips are cut to it and only the cells whose origin lies inside it are returned.
+    Stops between strips when the feedback is canceled.
+    """
+    geometries = {}
+    index = QgsSpatialIndex()
+    extent = QgsRectangle()
+    for feature in features:
+        geom = feature.geometry()
+        if geom.isEmpty():
+            continue
+        if buffer_distance:
+            geom = geom.buffer(buffer_distance, 5)
+        geometries[feature.id()] = geom
+        index.addFeature(feature.id(), geom.boundingBox())
+        extent.combineExtentWith(geom.boundingBox())
+
+    xs, ys, fids = [], [], []
+    if not geometries:
+        return np.array(xs, dtype=np.int64), np.array(ys, dtype=np.int64), np.array(fids, dtype=np.int64)
+
+    y_min = math.floor(extent.yMinimum() / CELL_SIZE) * CELL_SIZE
+    y_max = math.ceil(extent.yMaximum() / CELL_SIZE) * CELL_SIZE
+    x_left, x_right = extent.xMinimum(), extent.xMaximum()
+    x_stop = None
+    if cell_extent is not None:
+        # The first and the (excluded) last cell origin inside the extent, on both axes
+        y_min = max(y_min, math.ceil(cell_extent.yMinimum() / CELL_SIZE) * CELL_SIZE)
+        y_max = min(y_max, math.ceil(cell_extent.yMaximum() / CELL_SIZE) * CELL_SIZE)
+        x_stop = math.ceil(cell_extent.xMaximum() / CELL_SIZE) * CELL_SIZE
+        x_left = max(x_left, math.ceil(cell_extent.xMinimum() / CELL_SIZE) * CELL_SIZE)
+        x_right = min(x_right, x_stop)
+        if x_left > x_right:
+            return np.array(xs, dtype=np.int64), np.array(ys, dtype=np.int64), np.array(fids, dtype=np.int64)
+
+    for y in range(y_min, y_max, CELL_SIZE):
+        check_canceled(feedback)
+        strip = QgsRectangle(x_left, y, x_right, y + CELL_SIZE)
+        for fid in index.intersects(strip):
+            part = geometries[fid].clipped(strip)
+            if part.isEmpty():
+                continue
+            part_box = part.boundingBox()
+            x_start = math.floor(part_box.xMinimum() / CELL_SIZE) * CELL_SIZE
+            x_end = max(math.ceil(part_box.xMaximum() / CELL_SIZE) * CELL_SIZE, x_start + CELL_SIZE)
+            if x_stop is not None:
+                x_end = min(x_end, x_stop)
+            for x in range(x_start, x_end, CELL_SIZE):
+                if part.intersects(QgsRectangle(x, y, x + CELL_SIZE, y + CELL_SIZE)):
+                    xs.append(x)
+                    ys.append(y)
+                    fids.append(fid)
+
+    return np.array(xs, dtype=np.int64), np.array(ys, dtype=np.int64), np.array(fids, dtype=np.int64)
+
+def covered_cell_origins(polygon_layer, buffer_distance=0, padding=False):
+    """
+    Return the unique origins of the cells intersecting the selected (or all) polygons.
+    With padding the 8 neighbors of every such cell are included as well.
+    """
+    features = polygon_layer.selectedFeatures() or polygon_layer.getFeatures()
+    xs, ys, _ = polygon_cell_pairs(features, buffer_distance)
+    if padding:
+        return cell_origins_from_keys(np.unique(neighbor_keys(cell_keys(xs, ys))))
+    origins = np.unique(np.stack([xs, ys], axis=1), axis=0)
+    return origins[:, 0], origins[:, 1]
+
+def squares_to_wkb(xs, ys):
+    """Build the WKB of a square polygon for every cell origin in one vectorized pass."""
+    records = np.empty(len(xs), dtype=SQUARE_WKB_DTYPE)
+    records['byte_order'] = 1
+    records['wkb_type'] = 3  # Polygon
+    records['num_rings'] = 1
+    records['num_points'] = 5
+
+    x0 = xs.astype(np.float64)
+    y0 = ys.astype(np.float64)
+    x1 = x0 + CELL_SIZE
+    y1 = y0 + CELL_SIZE
+    coords = records['coords']
+    coords[:, 0, 0], coords[:, 0, 1] = x0, y0
+    coords[:, 1, 0], coords[:, 1, 1] = x1, y0
+    coords[:, 2, 0], coords[:, 2, 1] = x1, y1
+    coords[:, 3, 0], coords[:, 3, 1] = x0, y1
+    coords[:, 4, 0], coords[:, 4, 1] = x0, y0
+
+    buffer = records.tobytes()
+    size = SQUARE_WKB_DTYPE.itemsize
+    return [buffer[i:i + size] for i in range(0, len(buffer), size)]
+
+def create_grid_layer(crs="EPSG:28992", layer_name="Square Grid"):
+    """Create an empty memory layer for grid cells with an 'id' field."""
+    grid_layer = QgsVectorLayer(f"Polygon?crs={crs}", layer_name, "memory")
     pr = grid_layer.dataProvider()
-    
-    # Add fields to the layer
     pr.addAttributes([QgsField("id", QVariant.String)])
     grid_layer.updateFields()
-    
-    features = []
-    x = x_min
-    while x < x_max:
-        y = y_min
-        while y < y_max:
-            square_geom = QgsGeometry.fromRect(QgsRectangle(x, y, x + CELL_SIZE, y + CELL_SIZE))
-            feature = QgsFeature()
+    return grid_layer
+
+def add_squares_to_layer(grid_layer, xs, ys, attribute_rows=None, chunk_size=GRID_CHUNK_SIZE, feedback=None):
+    """
+    Stream square cells into the layer provider in chunks to keep memory bounded.
+    If attribute_rows is given, each row is appended to the attributes after the cell id.
+    Stops between chunks when the feedback is canceled.
+    """
+    pr = grid_layer.dataProvider()
+    fields = grid_layer.fields()
+
+    for start in range(0, len(xs), chunk_size):
+        check_canceled(feedback)
+        chunk_xs = xs[start:start + chunk_size]
+        chunk_ys = ys[start:start + chunk_size]
+        # Set the ID to the coordinates of the bottom-left corner of the square
+        ids = cell_ids(chunk_xs, chunk_ys)
+
+        features = []
+        for i, (wkb, cell_id) in enumerate(zip(squares_to_wkb(chunk_xs, chunk_ys), ids)):
+            square_geom = QgsGeometry()
+            square_geom.fromWkb(wkb)
+            feature = QgsFeature(fields)
             feature.setGeometry(square_geom)
-            # Set the ID to the coordinates of the bottom-left corner of the square
-            feature.setAttributes([f"{x}-{y}"])
+            if attribute_rows is None:
+                feature.setAttributes([cell_id])
+            else:
+                feature.setAttributes([cell_id] + list(attribute_rows[start + i]))
             features.append(feature)
-            y += CELL_SIZE
-        x += CELL_SIZE
-    
-    pr.addFeatures(features)
+        pr.addFeatures(features)
+
     grid_layer.updateExtents()
-    
+
+def create_squares_from_bbox(bbox, crs="EPSG:28992"):
+    """Create a grid of square cells from a bounding box."""
+    xs, ys = grid_cell_origins(bbox)
+    grid_layer = create_grid_layer(crs)
+    add_squares_to_layer(grid_layer, xs, ys)
+    return grid_layer
+
+def create_squares_from_polygons(polygon_layer, buffer_distance=0, padding=True, crs="EPSG:28992"):
+    """
+    Create a grid of square cells covering only the selected (or all) polygons. With padding the grid
+    keeps a ring of one cell around them, like the bbox grid, so the vogels territorium of the edge
+    cells still sees the birds observed just outside the polygons.
+    """
+    xs, ys = covered_cell_origins(polygon_layer, buffer_distance, padding)
+    grid_layer = create_grid_layer(crs)
+    add_squares_to_layer(grid_layer, xs, ys)
     return grid_layer
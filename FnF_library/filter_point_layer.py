@@ -1,38 +1,87 @@
 import os
 import pandas as pd
-from qgis.core import QgsProject, QgsVectorLayer, QgsFeatureRequest, QgsField
+from qgis.core import QgsProject, QgsVectorLayer, QgsFeatureRequest, QgsField, QgsExpression
 
 from .column_checker import load_column_settings
+from .species_tables import species_by_name
+
+def classify_species(species_values, species_index):
+    """Label a whole column of species names with their soortgroep in one pass (None if unknown)."""
+    soortgroep_by_name = {name: entry['soortgroep'] for name, entry in species_index.items()}
+    names = pd.Series(species_values, dtype=object).str.lower()
+    return names.map(soortgroep_by_name)
+
+
+def split_feature_ids_by_group(point_layer, species_column_name, species_index):
+    """Split the feature ids of the point layer into 'vogels' and other qualifying species."""
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes([species_column_name], point_layer.fields())
+
+    feature_ids = []
+    species_values = []
+    for feature in point_layer.getFeatures(request):
+        species_value = feature[species_column_name]
+        feature_ids.append(feature.id())
+        species_values.append(species_value if isinstance(species_value, str) else None)
+
+    soortgroepen = classify_species(species_values, species_index)
+    feature_ids = pd.Series(feature_ids, dtype='int64')
+    is_vogel = (soortgroepen == 'vogels').to_numpy()
+    is_known = soortgroepen.notna().to_numpy()
+
+    feature_ids_vogels = feature_ids[is_vogel].tolist()
+    feature_ids_others = feature_ids[is_known & ~is_vogel].tolist()
+    return feature_ids_vogels, feature_ids_others
+
+
+def species_values_by_group(point_layer, species_column_name, species_index):
+    """
+    Classify the distinct species values of the point layer, returning the raw values
+    belonging to 'vogels' and to the other qualifying species groups.
+    """
+    field_index = point_layer.fields().indexOf(species_column_name)
+    species_values = sorted(value for value in point_layer.uniqueValues(field_index) if isinstance(value, str))
+
+    soortgroepen = classify_species(species_values, species_index)
+    vogels_values = [value for value, group in zip(species_values, soortgroepen) if group == 'vogels']
+    others_values = [
+        value for value, group in zip(species_values, soortgroepen)
+        if isinstance(group, str) and group != 'vogels'
+    ]
+    return vogels_values, others_values
+
+
+def species_filter_string(point_layer, species_column_name, species_values):
+    """
+    Build a subset string selecting the given species values, on top of any existing subset.
+    Its length depends on the number of distinct species, not on the number of observations.
+    """
+    if species_values:
+        quoted_values = ', '.join(QgsExpression.quotedString(value) for value in species_values)
+        filter_string = f"{QgsExpression.quotedColumnRef(species_column_name)} IN ({quoted_values})"
+    else:
+        filter_string = "1 = 0"
+
+    if point_layer.subsetString():
+        filter_string = f"({point_layer.subsetString()}) AND ({filter_string})"
+    return filter_string
+
 
 def filter_point_layer_with_request(point_layer):
     """Filter the point layer into 'Vogels' and 'Others' based on the species list."""
     species_settings_file = os.path.join(os.path.dirname(__file__), 'point_column_settings_file.txt')
     species_column_name = load_column_settings(species_settings_file).get('Soortnaam_NL')
-    species_file_path = os.path.join(os.path.dirname(__file__), 'relation_tables', 'bij12_kwalificerendesoorten_fix.csv')
 
     try:
-        species_list = pd.read_csv(species_file_path)
+        species_index = species_by_name()
         print(f"Species list loaded successfully.")
     except Exception as e:
         print(f"Error loading species file: {e}")
         return None, None
 
-    # Initialize empty lists for feature IDs
-    feature_ids_vogels = []
-    feature_ids_others = []
-
     # Filter features based on species
-    for feature in point_layer.getFeatures():
-        species_value = feature[species_column_name]
-        matching_species = species_list[species_list['ned_naam'].str.lower() == species_value.lower()]
-
-        if not matching_species.empty:
-            if matching_species['ned_soortgroep'].values[0] == 'vogels':
-                feature_ids_vogels.append(feature.id())
-            else:
-                feature_ids_others.append(feature.id())
-
-    return feature_ids_vogels, feature_ids_others
+    return split_feature_ids_by_group(point_layer, species_column_name, species_index)
 
 
 def filter_point_layer_to_temp_layer(point_layer, add_to_map = True):
@@ -44,63 +93,41 @@ def filter_point_layer_to_temp_layer(point_layer, add_to_map = True):
     species_settings_file = os.path.join(os.path.dirname(__file__), 'point_column_settings_file.txt')
     species_column_name = load_column_settings(species_settings_file).get('Soortnaam_NL')
     group_column_name = load_column_settings(species_settings_file).get('ned_soortgroep')
-    species_file_path = os.path.join(os.path.dirname(__file__), 'relation_tables', 'bij12_kwalificerendesoorten_fix.csv')
 
     # Load species list
     try:
-        species_list = pd.read_csv(species_file_path)
+        species_index = species_by_name()
         print(f"Species list loaded successfully.")
     except Exception as e:
         print(f"Error loading species file: {e}")
         return None, None
 
-    # Filter features based on species
-    feature_ids_vogels = []
-    feature_ids_others = []
-
-    for feature in point_layer.getFeatures():
-        species_value = feature[species_column_name]
-        matching_species = species_list[species_list['ned_naam'].str.lower() == species_value.lower()]
-
-
-        if not matching_species.empty:
-            if matching_species['ned_soortgroep'].values[0] == 'vogels':
-                feature_ids_vogels.append(feature.id())
-            else:
-                feature_ids_others.append(feature.id())
-
-    print(f"Vogels feature IDs: {feature_ids_vogels}")
-    print(f"Others feature IDs: {feature_ids_others}")
-
-    # Create filter strings directly from feature IDs
-    if feature_ids_vogels:
-        vogels_filter_string = f"\"{point_layer.fields()[0].name()}\" IN ({', '.join(map(str, feature_ids_vogels))})"
-    else:
-        vogels_filter_string = ""
-        
-    if feature_ids_others:
-        others_filter_string = f"\"{point_layer.fields()[0].name()}\" IN ({', '.join(map(str, feature_ids_others))})"
+    # Filter on the distinct species values per group instead of on every matched feature id
+    vogels_values, others_values = species_values_by_group(point_layer, species_column_name, species_index)
+    vogels_filter_string = species_filter_string(point_layer, species_column_name, vogels_values)
+    others_filter_string = species_filter_string(point_layer, species_column_name, others_values)
+
+    print(f"Number of Vogels species: {len(vogels_values)}")
+    print(f"Number of Others species: {len(others_values)}")
+
+    # Create new layers based on the filtered species
+    if point_layer.providerType() == 'memory':
+        # A memory source cannot be reopened, copy the matching features into new memory layers
+        vogels_layer = point_layer.materialize(QgsFeatureRequest().setFilterExpression(vogels_filter_string))
+        others_layer = point_layer.materialize(QgsFeatureRequest().setFilterExpression(others_filter_string))
+        vogels_layer.setName('Vogels Layer')
+        others_layer.setName('Others Layer')
     else:
-        others_filter_string = ""
-
-    print(f"Vogels filter string: {vogels_filter_string}")
-    print(f"Others filter string: {others_filter_string}")
-
-    # Create new layers based on the filtered feature IDs
-    vogels_layer = QgsVectorLayer(point_layer.source(), 'Vogels Layer', point_layer.providerType())
-    others_layer = QgsVectorLayer(point_layer.source(), 'Others Layer', point_layer.providerType())
+        vogels_layer = QgsVectorLayer(point_layer.source(), 'Vogels Layer', point_layer.providerType())
+        others_layer = QgsVectorLayer(point_layer.source(), 'Others Layer', point_layer.providerType())
+        vogels_layer.setSubsetString(vogels_filter_string)
+        others_layer.setSubsetString(others_filter_string)
 
     if not vogels_layer.isValid():
         print("Vogels layer is not valid!")
     if not others_layer.isValid():
         print("Others layer is not valid!")
 
-    # Set subset strings if filter strings are not empty
-    if vogels_filter_string:
-        vogels_layer.setSubsetString(vogels_filter_string)
-    if others_filter_string:
-        others_layer.setSubsetString(others_filter_string)
-
     # Debug feature counts after applying subset string
     print(f"Number of features in Vogels layer after subset: {vogels_layer.featureCount()}")
     print(f"Number of features in Others layer after subset: {others_layer.featureCount()}")
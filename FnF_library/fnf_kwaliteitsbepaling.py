@@ -1,29 +1,79 @@
 import os
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from qgis.core import (
-    QgsSpatialIndex,
     QgsField,
     QgsVectorLayer,
     QgsFeature,
+    QgsVectorLayerFeatureSource,
+    QgsExpression,
     QgsProject,
     edit,
-    QgsProcessingFeatureSourceDefinition,
     QgsApplication,
     QgsTask,
+    QgsProcessingFeedback,
     QgsMessageLog,
     Qgis,
 )
-from qgis.analysis import QgsNativeAlgorithms
-from PyQt5.QtCore import QVariant
-import processing
+from PyQt5.QtCore import QVariant, QDateTime
 from .column_checker import load_column_settings
 from .filter_point_layer import filter_point_layer_to_temp_layer
-from .vogels_territorium_calc import vogels_territorium
+from .vogels_territorium_calc import vogels_territorium_matrix
+from .cell_species_matrix import (
+    species_matrix,
+    empty_matrix,
+    filter_entries,
+    concat_matrices,
+    cell_keys_of,
+    species_lists,
+)
+from .species_tables import file_signature, BIJ12_SPECIES_FILE, BIJ12_SPECIES_XLSX, KWALITEIT_KLASSEN_FILE
+from .kwalificerende_soorten_score import score_cells
+from .processing_setup import check_canceled
+from .layer_joins import (
+    spatial_join_two_layers,
+    index_join_two_layers,
+    categorize_columns,
+    vectorlayer_to_df,
+    bin_point_chunks,
+    grid_cell_index,
+    join_point_chunks,
+    layer_chunks,
+    polygon_cells_to_df,
+)
+from .result_cache import result_cache_key, load_cached_result, store_result
+from .run_report import RunReport
+from .incremental_run import run_key, run_state, layer_fingerprints, begin_run, end_run, remember_run
+from .gpkg_sql_backend import gpkg_sources, gpkg_point_chunks, gpkg_grid_cell_keys, gpkg_polygon_cells
+from .create_ha_polygon_layer import (
+    get_bounding_box_from_selection,
+    grid_extent,
+    cell_keys_from_ids,
+    check_grid_ids,
+    cell_ids_from_keys,
+    cell_origins_from_keys,
+    cell_keys_in_extent,
+    tile_extents,
+    CELL_SIZE,
+    create_grid_layer,
+    add_squares_to_layer,
+)
+
+WRITE_CHUNK_SIZE = 50000  # Number of features added to a result layer per batch
+TILED_CELL_THRESHOLD = 250000  # Grids with more cells than this are processed in tiles
 
-def load_species_list():
-    """Load the species list CSV."""
-    species_file_path = os.path.join(os.path.dirname(__file__), 'relation_tables', 'bij12_kwalificerendesoorten_fix.csv')
-    return pd.read_csv(species_file_path)
+# Share of each stage in the progress of a JoinAndProcessTask, in percent
+PROGRESS_STAGES = {
+    'join polygons': 20,
+    'join points': 35,
+    'territorium': 5,
+    'aggregate': 20,
+    'write': 20,
+}
 
 def load_column_settings_files():
     """Load the column settings for both point and polygon layers."""
@@ -37,152 +87,603 @@ def load_column_settings_files():
     return species_column_name, polygon_beheertype_name, polygon_gebied_name
 
 
-def spatial_join_two_layers(target_layer, join_layer, joining_fields, selection_only= False):
-    """
-    Perform a spatial join between two QGIS vector layers using 'native:joinattributesbylocation'.
-    """
-    QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
-
-    if not target_layer or not join_layer:
-        raise ValueError("One or both input layers are invalid.")
-
-    params = {
-        'INPUT': QgsProcessingFeatureSourceDefinition(
-            target_layer.id(),
-            selectedFeaturesOnly=False,
-        ),
-        'JOIN': QgsProcessingFeatureSourceDefinition(
-            join_layer.id(),
-            selectedFeaturesOnly=selection_only,
-        ),
-        'PREDICATE': [0],
-        'JOIN_FIELDS': joining_fields,
-        'METHOD': 0,
-        'DISCARD_NONMATCHING': False,
-        'OUTPUT': 'memory:',
-    }
-
-    result = processing.run("native:joinattributesbylocation", params)
-
-    return result
+def load_date_column_name():
+    """Load the name of the observation date column from the point column settings, if set."""
+    species_settings_file = os.path.join(os.path.dirname(__file__), 'point_column_settings_file.txt')
+    return load_column_settings(species_settings_file).get('Datum')
 
 
-def vectorlayer_to_df(vectorlayer):
-    """Convert a QGIS vector layer to a pandas DataFrame."""
-    if not vectorlayer.isValid():
-        raise ValueError("Invalid vector layer.")
-    fields = [field.name() for field in vectorlayer.fields()]
-    data = [{field: feature[field] for field in fields} for feature in vectorlayer.getFeatures()]
-    return pd.DataFrame(data)
+def year_filter_expression(point_layer, date_column, begin_year=None, end_year=None):
+    """
+    Build a filter expression keeping the observations from 1 January of begin_year up to and
+    including 31 December of end_year. Date, datetime and ISO date text columns are compared with
+    ISO dates, numeric columns are taken to hold the year. The expression only uses plain
+    comparisons so providers such as GeoPackage can run it as SQL.
+    Returns None when there is nothing to filter on.
+    """
+    if not date_column or point_layer.fields().indexOf(date_column) == -1:
+        return None
+    if begin_year is None and end_year is None:
+        return None
+
+    column = QgsExpression.quotedColumnRef(date_column)
+    field = point_layer.fields().field(date_column)
+    conditions = []
+    if field.isNumeric():
+        if begin_year is not None:
+            conditions.append(f"{column} >= {int(begin_year)}")
+        if end_year is not None:
+            conditions.append(f"{column} <= {int(end_year)}")
+    else:
+        if begin_year is not None:
+            conditions.append(f"{column} >= '{int(begin_year):04d}-01-01'")
+        if end_year is not None:
+            conditions.append(f"{column} < '{int(end_year) + 1:04d}-01-01'")
+    return ' AND '.join(conditions)
+
+
+def fold_aggregates(running_df, chunk_df, aggr_expression):
+    """
+    Combine two per-cell aggregates of the same rules: the cells in both get each rule applied
+    again to the values of both, with list results flattened first. This holds for rules that
+    can be applied to their own results, such as set unions, min, max and sum.
+    """
+    if running_df is None:
+        return chunk_df
+    combined = pd.concat([running_df, chunk_df], ignore_index=True)
+    in_both = combined['id'].duplicated(keep=False).to_numpy()
+    if not in_both.any():
+        return combined
+
+    def reapply(rule):
+        def refold(values):
+            flat = [
+                item for value in values
+                for item in (value if isinstance(value, list) else [value])
+            ]
+            return rule(pd.Series(flat, dtype=object))
+        return refold
+
+    refolded = combined[in_both].groupby('id').agg(
+        {column: reapply(rule) for column, rule in aggr_expression.items()}
+    ).reset_index()
+    return pd.concat([combined[~in_both], refolded], ignore_index=True)
 
 
 def pd_aggr_layer(df_layer_to_aggr, aggr_expression):
     """Aggregate a DataFrame using a given aggregation expression."""
+    # Categorical columns are aggregated as plain objects, pandas cannot cast lists back to categories
+    categorical_columns = {
+        column: object for column in aggr_expression
+        if isinstance(df_layer_to_aggr[column].dtype, pd.CategoricalDtype)
+    }
+    df_layer_to_aggr = df_layer_to_aggr.astype(categorical_columns)
     return df_layer_to_aggr.groupby('id').agg(aggr_expression).reset_index()
 
 
-def df_to_project(df, layer_name):
-    """Add a pandas DataFrame as a layer to the QGIS project."""
-    layer = QgsVectorLayer("None", layer_name, "memory")
+def qgs_field_for_column(name, column):
+    """Map a pandas column dtype to a QgsField; lists and text become String fields."""
+    if pd.api.types.is_bool_dtype(column):
+        return QgsField(name, QVariant.Bool)
+    if pd.api.types.is_integer_dtype(column):
+        return QgsField(name, QVariant.LongLong)
+    if pd.api.types.is_float_dtype(column):
+        return QgsField(name, QVariant.Double)
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return QgsField(name, QVariant.DateTime)
+    return QgsField(name, QVariant.String)
+
+
+def list_to_text(values):
+    """Serialize a list of values as compact JSON text, sorted for a stable output."""
+    return json.dumps(sorted(values, key=str), ensure_ascii=False, separators=(',', ':'))
+
+
+def column_to_attribute_values(column):
+    """Convert a pandas column to attribute values; lists and dicts become JSON text and missing values NULL."""
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.is_integer_dtype(column):
+        return column.tolist()
+    if pd.api.types.is_float_dtype(column):
+        return [None if np.isnan(value) else value for value in column.tolist()]
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return [None if pd.isna(value) else QDateTime(value.to_pydatetime()) for value in column]
+
+    values = []
+    for value in column.tolist():
+        if isinstance(value, (list, set, tuple)):
+            values.append(list_to_text(value))
+        elif isinstance(value, dict):
+            values.append(json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':')))
+        elif value is None or (isinstance(value, float) and np.isnan(value)):
+            values.append(None)
+        else:
+            values.append(str(value))
+    return values
+
+
+def df_to_project(df, layer_name, with_grid_geometry=False, feedback=None):
+    """
+    Add a pandas DataFrame as a layer to the QGIS project, with typed fields and batched writes.
+    With with_grid_geometry the 'id' column holds cell keys, which are turned back into grid cell squares.
+    Returns the added layer; the layer is not added when the feedback is canceled while writing.
+    """
+    if with_grid_geometry:
+        attribute_columns = [name for name in df.columns if name != 'id']
+        layer = create_grid_layer(layer_name=layer_name)
+    else:
+        attribute_columns = list(df.columns)
+        layer = QgsVectorLayer("None", layer_name, "memory")
     provider = layer.dataProvider()
 
-    fields = [QgsField(name, QVariant.String) for name in df.columns]
+    fields = [qgs_field_for_column(name, df[name]) for name in attribute_columns]
     provider.addAttributes(fields)
     layer.updateFields()
 
-    for _, row in df.iterrows():
-        feature = QgsFeature()
-        feature.setAttributes([str(value) for value in row.values])
-        provider.addFeature(feature)
+    rows = list(zip(*[column_to_attribute_values(df[name]) for name in attribute_columns]))
+    if with_grid_geometry:
+        xs, ys = cell_origins_from_keys(df['id'])
+        add_squares_to_layer(layer, xs, ys, rows or [()] * len(df), feedback=feedback)
+    else:
+        for start in range(0, len(rows), WRITE_CHUNK_SIZE):
+            check_canceled(feedback)
+            features = []
+            for row in rows[start:start + WRITE_CHUNK_SIZE]:
+                feature = QgsFeature(layer.fields())
+                feature.setAttributes(list(row))
+                features.append(feature)
+            provider.addFeatures(features)
 
     QgsProject.instance().addMapLayer(layer)
+    return layer
 
 
-def process_and_add_to_project(join_result, aggregation_rules, layer_name, to_project = True):
-    """Process join results and add them as a layer to the project."""
-    if 'OUTPUT' not in join_result:
-        raise ValueError("Join result does not contain 'OUTPUT'.")
-
-    join_output = join_result['OUTPUT']
-    df_layer = vectorlayer_to_df(join_output)
-    aggregated_df = pd_aggr_layer(df_layer, aggregation_rules)
-    if to_project:
-        df_to_project(aggregated_df, layer_name)
-    return aggregated_df
+def merge_cell_frames(aggr_df_grid_polygon, merged_vogels_territorium_df):
+    """Merge the processed polygon and point DataFrames on 'id'."""
+    return pd.merge(
+        aggr_df_grid_polygon,
+        merged_vogels_territorium_df,
+        on="id",
+        how="outer"
+    )
 
 
 class JoinAndProcessTask(QgsTask):
-    def __init__(self, grid_layer, polygon_layer, point_layer, polygon_rules, point_rules):
+    """
+    Join the polygon and point layers to the hectare grid (or the implicit grid without a grid layer),
+    aggregate them per cell and score the qualifying species per beheertype.
+    """
+    def __init__(self, grid_layer, polygon_layer, point_layer, polygon_rules, point_rules,
+                 use_processing_join=False, concurrent_joins=True, tiled=False,
+                 beheertype_column='beheerType', species_column='Soortnaam_NL', point_filter=None,
+                 use_gpkg_sql=False, incremental=False, result_cache_key=None, profile=False):
         super().__init__("Join and Process Layers")
+        # The joins pack the grid ids into cell keys, other ids would fail or merge cells halfway in the run
+        if grid_layer is not None:
+            check_grid_ids(grid_layer)
         self.grid_layer = grid_layer
         self.polygon_layer = polygon_layer
         self.point_layer = point_layer
         self.polygon_rules = polygon_rules
         self.point_rules = point_rules
-
-    def run(self,  polygon_aggr = True):
-        try:
-            grid_polygon_join = spatial_join_two_layers(
-                self.grid_layer, self.polygon_layer, list(self.polygon_rules.keys())
-            )
-
-            grid_point_join = spatial_join_two_layers(
-                self.grid_layer, self.point_layer, list(self.point_rules.keys())
-            )
-
-            
-            if polygon_aggr:
-                aggr_df_grid_polygon = process_and_add_to_project(
-                    grid_polygon_join,
-                    self.polygon_rules,
-                    "Grid_beheertypen_lijst",
-                    to_project = False
+        self.beheertype_column = beheertype_column
+        self.species_column = species_column
+        # Filter expression on the observations (year window), applied when the points are read
+        self.point_filter = point_filter
+        self.use_processing_join = use_processing_join
+        self.result_cache_key = result_cache_key
+        # cProfile only sees the thread it runs in, so a profiled run does all work in the task thread;
+        # processing.run is not run from two threads at once, so the processing joins run one after the other
+        self.concurrent_joins = concurrent_joins and not profile and not use_processing_join
+        # The processing join always handles the whole layers, so it is never tiled
+        self.tiled = tiled and not use_processing_join
+
+        # The feedback is shared by all worker threads: it carries the progress and the cancellation
+        self.feedback = QgsProcessingFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+        self.stage_done = dict.fromkeys(PROGRESS_STAGES, 0.0)
+        self.progress_lock = threading.Lock()
+        self.point_count = max(1, point_layer.featureCount())
+
+        # Table descriptions of the GeoPackage backend, None when the layers are not in one GeoPackage
+        self.gpkg = None
+        if use_gpkg_sql and not use_processing_join:
+            self.gpkg = gpkg_sources(grid_layer, polygon_layer, point_layer)
+            if self.gpkg is None:
+                QgsMessageLog.logMessage(
+                    "The input layers are not saved in one GeoPackage, the joins run in QGIS.", level=Qgis.Info
                 )
-            else:
-                grid_polygon_join_output = grid_polygon_join['OUTPUT']
-                aggr_df_grid_polygon = vectorlayer_to_df(grid_polygon_join_output)
-
-            aggr_df_grid_point = process_and_add_to_project(
-                grid_point_join,
-                self.point_rules,
-                "Grid_point_lijst",
-                to_project = False
-            )
-
-            vogels_territorium_df = vogels_territorium(aggr_df_grid_point)
-            merged_vogels_territorium_df = pd.merge(
-                aggr_df_grid_point,
-                vogels_territorium_df,
-                on="id",
-                how="outer"
-            )
 
-            # Merge the processed DataFrames on 'id'
-            merged_df = pd.merge(
-                aggr_df_grid_polygon,
-                merged_vogels_territorium_df,
-                on="id",
-                how="outer"
+        if grid_layer is None:
+            # Only keep observations inside the grid that would cover the selected (or all) polygons
+            self.polygon_selection = polygon_layer.selectedFeatureIds()
+            bbox = get_bounding_box_from_selection(polygon_layer) or polygon_layer.extent()
+            self.point_extent = grid_extent(bbox)
+            cell_extent = self.point_extent
+        else:
+            cell_extent = grid_layer.extent()
+
+        # The processing join always handles the whole layers, so it cannot be rerun per tile
+        self.incremental = incremental and not use_processing_join
+        self.run_key = None
+        self.previous_state = None
+        self.update_tiles = None
+        self.seen_edits = 0
+        self.start_commits = None
+        self.result_df = None
+        if self.incremental:
+            self.run_key = run_key(
+                grid_layer, polygon_layer, point_layer, point_filter,
+                tuple(polygon_rules), tuple(point_rules),
+                tuple(sorted(self.polygon_selection)) if grid_layer is None else None,
             )
-            df_to_project(merged_df, "Grid_Combined")
+            self.start_fingerprints = layer_fingerprints(self.input_layers())
+            self.previous_state = run_state(self.run_key)
+            if self.previous_state is not None:
+                # The edits are only forgotten when this run finishes successfully
+                self.update_tiles, self.seen_edits = self.previous_state.dirty_tiles(cell_extent)
+                self.start_commits = self.previous_state.commits()
+
+        if self.update_tiles is not None:
+            # Only the tiles around the edits since the last run are processed
+            self.tiled = True
+            self.tiles = self.update_tiles
+            self.worker_count = max(1, min(os.cpu_count() or 1, len(self.tiles)))
+        elif self.tiled:
+            # One extra cell around the grid for the vogels territorium of the border cells
+            self.tiles = tile_extents(cell_extent.buffered(CELL_SIZE))
+            self.worker_count = max(1, min(os.cpu_count() or 1, len(self.tiles)))
+        else:
+            self.worker_count = 2 if self.concurrent_joins else 1
+        if profile:
+            self.worker_count = 1
+        # Part of a stage done by one tile (or by the whole grid)
+        self.progress_share = 1.0 / len(self.tiles) if self.tiled and self.tiles else 1.0
+
+        # The run report is started when the task runs, the input counts are taken here on the main thread
+        self.profile = profile
+        self.report = None
+        self.report_details = {
+            'grid_features': grid_layer.featureCount() if grid_layer is not None else None,
+            'polygon_features': polygon_layer.featureCount(),
+            'point_features': point_layer.featureCount(),
+            'tiles': len(self.tiles) if self.tiled else None,
+            'workers': self.worker_count,
+            'incremental_update': self.update_tiles is not None,
+            'join': 'processing' if use_processing_join else 'gpkg_sql' if self.gpkg is not None else 'index',
+        }
+
+        # Feature sources are created here on the main thread, one set per worker thread
+        self.source_pool = queue.Queue()
+        for _ in range(self.worker_count):
+            self.source_pool.put(self.create_sources())
+
+    def input_layers(self):
+        """Return the input layers of the run, without the grid layer when the grid is implicit."""
+        return [layer for layer in (self.grid_layer, self.polygon_layer, self.point_layer) if layer is not None]
+
+    def create_sources(self):
+        """Create a set of feature sources for the layers, to be iterated by one thread at a time."""
+        sources = {
+            'polygon': QgsVectorLayerFeatureSource(self.polygon_layer),
+            'point': QgsVectorLayerFeatureSource(self.point_layer),
+        }
+        if self.grid_layer is not None:
+            sources['grid'] = QgsVectorLayerFeatureSource(self.grid_layer)
+        return sources
+
+    def cancel(self):
+        """Cancel the task; the worker threads stop at their next cancellation check."""
+        self.feedback.cancel()
+        super().cancel()
+
+    def report_progress(self, stage, done):
+        """Add the part done of a stage (out of 1 for the whole stage) and update the task progress."""
+        with self.progress_lock:
+            self.stage_done[stage] = min(1.0, self.stage_done[stage] + done)
+            progress = sum(PROGRESS_STAGES[name] * part for name, part in self.stage_done.items())
+        self.feedback.setProgressText(stage)
+        self.feedback.setProgress(progress)
+
+    def run_with_sources(self, function, *args):
+        """Run function(sources, *args) with a set of feature sources taken from the pool."""
+        sources = self.source_pool.get()
+        try:
+            return function(sources, *args)
+        finally:
+            self.source_pool.put(sources)
 
+    def run(self,  polygon_aggr = True):
+        """Process the layers with a RunReport of the time, rows and memory per stage, profiled when profile is set."""
+        self.report = RunReport('toets', profile=self.profile, details=self.report_details)
+        status = 'failed'
+        try:
+            with self.report.profiled():
+                self.process(polygon_aggr)
+            status = 'completed'
             return True
         except Exception as e:
-            QgsMessageLog.logMessage(f"Error during task execution: {e}", level=Qgis.Critical)
+            # A canceled task is reported in finished
+            if self.isCanceled():
+                status = 'canceled'
+            else:
+                QgsMessageLog.logMessage(f"Error during task execution: {e}", level=Qgis.Critical)
             return False
+        finally:
+            try:
+                self.report.finish(status)
+            except OSError as e:
+                QgsMessageLog.logMessage(f"Run report not written: {e}", level=Qgis.Warning)
+
+    def process(self, polygon_aggr=True):
+        """
+        Compute the cells, or in an incremental run only those of the tiles edited since the last run,
+        write Grid_Combined and store it in the result cache when there is a result_cache_key.
+        """
+        if self.update_tiles is None:
+            merged_df = self.compute_cells(polygon_aggr)
+        else:
+            # Without edits since the last run nothing is recomputed
+            updated_df = self.compute_cells(polygon_aggr) if self.update_tiles else None
+            with self.report.stage('update', tiles=len(self.update_tiles)) as counts:
+                merged_df = self.previous_state.updated_result(updated_df, self.update_tiles)
+                counts['rows'] = len(merged_df)
+        self.result_df = merged_df
+
+        check_canceled(self.feedback)
+        with self.report.stage('write', rows=len(merged_df)):
+            if self.grid_layer is None:
+                output_layer = df_to_project(merged_df, "Grid_Combined", with_grid_geometry=True, feedback=self.feedback)
+            else:
+                # Cell keys are only rendered as 'x-y' ids for the output
+                output_layer = df_to_project(
+                    merged_df.assign(id=cell_ids_from_keys(merged_df['id'])), "Grid_Combined", feedback=self.feedback
+                )
+
+        if self.result_cache_key is not None:
+            with self.report.stage('cache', rows=len(merged_df)):
+                try:
+                    store_result(self.result_cache_key, output_layer)
+                except OSError as e:
+                    QgsMessageLog.logMessage(f"Result not cached: {e}", level=Qgis.Warning)
+        self.report_progress('write', 1.0)
+
+    def compute_cells(self, polygon_aggr=True):
+        """
+        Join, aggregate and score the cells of all tiles in a pool of worker threads, or of the whole
+        grid with the polygon and the point side in two threads unless concurrent_joins is off.
+        """
+        if self.tiled and self.worker_count == 1:
+            parts_list = [self.run_with_sources(self.tile_parts, tile, polygon_aggr) for tile in self.tiles]
+        elif self.tiled:
+            with ThreadPoolExecutor(max_workers=self.worker_count) as executor:
+                futures = [
+                    executor.submit(self.run_with_sources, self.tile_parts, tile, polygon_aggr)
+                    for tile in self.tiles
+                ]
+                parts_list = [future.result() for future in futures]
+        elif self.concurrent_joins:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                polygon_future = executor.submit(self.run_with_sources, self.polygon_frame, None, polygon_aggr)
+                point_future = executor.submit(self.run_with_sources, self.point_parts, None)
+                # Both sides must be finished before they are merged
+                parts = point_future.result()
+                parts['polygon'] = polygon_future.result()
+                parts_list = [parts]
+        else:
+            parts_list = [self.run_with_sources(self.tile_parts, None, polygon_aggr)]
+
+        check_canceled(self.feedback)
+        with self.report.stage('merge', parts=len(parts_list)) as counts:
+            merged_df, species = self.combine_parts(parts_list)
+            counts['rows'] = len(merged_df)
+
+        # Score the observed species (and bird territoria) against the beheertypes of each cell
+        with self.report.stage('score', rows=len(merged_df)):
+            merged_df = score_cells(merged_df, self.beheertype_column, species)
+        self.report_progress('aggregate', 1.0)
+        return merged_df
+
+    def tile_parts(self, sources, extent=None, polygon_aggr=True):
+        """Process the cells inside the extent (or all cells), both the polygon and the point side."""
+        # Tiles still waiting when the task is canceled are skipped
+        check_canceled(self.feedback)
+        parts = self.point_parts(sources, extent)
+        parts['polygon'] = self.polygon_frame(sources, extent, polygon_aggr)
+        return parts
+
+    def combine_parts(self, parts_list):
+        """
+        Stitch the parts of all tiles together, render the species matrices as list columns and
+        merge everything on 'id'. Also returns the union of the observed and territorium species.
+        """
+        # The tiles hold disjoint cells, so their results are simply stacked
+        polygon_df = pd.concat([parts['polygon'] for parts in parts_list], ignore_index=True)
+        point_df = pd.concat([parts['point'] for parts in parts_list], ignore_index=True)
+        species = concat_matrices([parts['species'] for parts in parts_list])
+        territorium = concat_matrices([parts['territorium'] for parts in parts_list])
+
+        point_df.insert(1, self.species_column, species_lists(species, point_df['id']))
+        territorium_keys = cell_keys_of(territorium)
+        vogels_territorium_df = pd.DataFrame({
+            'id': territorium_keys,
+            'vogels_territorium': species_lists(territorium, territorium_keys),
+        })
+        merged_vogels_territorium_df = pd.merge(
+            point_df,
+            vogels_territorium_df,
+            on="id",
+            how="outer"
+        )
+        merged_df = merge_cell_frames(polygon_df, merged_vogels_territorium_df)
+        return merged_df, concat_matrices([species, territorium])
+
+    def polygon_frame(self, sources, extent=None, polygon_aggr=True):
+        """Join the polygons to the grid cells, in SQL for a GeoPackage with SpatiaLite, and aggregate them per cell."""
+        fields = list(self.polygon_rules.keys())
+        with self.report.stage('join polygons') as counts:
+            if self.grid_layer is None:
+                df_grid_polygon = polygon_cells_to_df(
+                    sources['polygon'], fields, self.polygon_selection, extent, feedback=self.feedback
+                )
+            elif self.use_processing_join:
+                df_grid_polygon = self.processing_join_frame(self.polygon_layer, fields)
+            elif self.gpkg is not None and self.gpkg['spatialite']:
+                df_grid_polygon = categorize_columns(
+                    gpkg_polygon_cells(self.gpkg, fields, extent, feedback=self.feedback), fields
+                )
+            else:
+                df_grid_polygon = index_join_two_layers(
+                    sources['grid'], sources['polygon'], fields, extent=extent, feedback=self.feedback
+                )
+            counts['rows'] = len(df_grid_polygon)
+
+        if polygon_aggr:
+            with self.report.stage('aggregate polygons', rows=len(df_grid_polygon)) as counts:
+                df_grid_polygon = pd_aggr_layer(df_grid_polygon, self.polygon_rules)
+                counts['cells'] = len(df_grid_polygon)
+        self.report_progress('join polygons', self.progress_share)
+        return df_grid_polygon
+
+    def point_parts(self, sources, extent=None):
+        """
+        Join the points to the grid cells and build the species matrix and vogels territorium matrix.
+        The species column is held in the matrix, the other point fields are aggregated per cell.
+        With use_gpkg_sql the points are binned to cells in SQL inside the GeoPackage.
+        """
+        fields = list(self.point_rules.keys())
+        # Read one cell around the extent, so the territorium of the border cells sees the neighboring birds
+        halo_extent = extent.buffered(CELL_SIZE) if extent is not None else None
+
+        # The observations are read in chunks and folded into the running cell aggregates
+        with self.report.stage('join points') as counts:
+            grid_cell_keys = []
+            if self.gpkg is not None:
+                # Only the distinct (cell, values) rows binned inside the GeoPackage are read
+                point_extent = halo_extent
+                if self.grid_layer is None:
+                    point_extent = halo_extent.intersect(self.point_extent) if halo_extent is not None else self.point_extent
+                else:
+                    grid_cell_keys = gpkg_grid_cell_keys(self.gpkg, halo_extent, self.feedback)
+                chunks = gpkg_point_chunks(self.gpkg, fields, point_extent, self.point_filter, feedback=self.feedback)
+            elif self.grid_layer is None:
+                point_extent = halo_extent.intersect(self.point_extent) if halo_extent is not None else self.point_extent
+                chunks = bin_point_chunks(sources['point'], fields, point_extent, self.point_filter, feedback=self.feedback)
+            elif self.use_processing_join:
+                chunks = self.processing_join_chunks(self.point_layer, fields, self.point_filter)
+            else:
+                grid_index, cell_key_by_fid = grid_cell_index(sources['grid'], halo_extent, self.feedback)
+                # Cells without observations are kept, as in the join against the grid
+                grid_cell_keys = list(cell_key_by_fid.values())
+                chunks = join_point_chunks(
+                    grid_index, cell_key_by_fid, sources['point'], fields, halo_extent, self.point_filter,
+                    feedback=self.feedback
+                )
+            aggr_df_grid_point, species = self.fold_point_chunks(chunks, grid_cell_keys, counts)
+            counts['cells'] = len(aggr_df_grid_point)
+
+        with self.report.stage('territorium') as counts:
+            territorium = vogels_territorium_matrix(species)
+            counts['entries'] = len(territorium['keys'])
+        self.report_progress('territorium', self.progress_share)
+
+        if extent is not None:
+            inside = cell_keys_in_extent(aggr_df_grid_point['id'], extent)
+            aggr_df_grid_point = aggr_df_grid_point[inside].reset_index(drop=True)
+            species = filter_entries(species, cell_keys_in_extent(species['keys'], extent))
+            territorium = filter_entries(territorium, cell_keys_in_extent(territorium['keys'], extent))
+        return {'point': aggr_df_grid_point, 'species': species, 'territorium': territorium}
+
+    def fold_point_chunks(self, chunks, grid_cell_keys=(), counts=None):
+        """
+        Fold chunks of observations with their cell key as 'id' into the per-cell aggregates: the
+        species matrix, the aggregates of the other point fields and the union of the cell keys.
+        Only one chunk of raw observations is held at a time. The per-chunk results wait until they
+        hold as many entries as the running result and are then merged into it in one go, so every
+        entry is merged a logarithmic number of times instead of once per chunk.
+        The progress of the 'join points' stage follows the number of observations read, which is
+        also added to counts['rows'].
+        """
+        other_rules = {field: rule for field, rule in self.point_rules.items() if field != self.species_column}
+        keys = np.unique(np.asarray(grid_cell_keys, dtype=np.int64))
+        species = empty_matrix()
+        aggr_df = None
+        pending = {'keys': [], 'species': [], 'aggr': [], 'entries': 0}
+
+        def merge_pending():
+            nonlocal keys, species, aggr_df
+            if pending['keys']:
+                keys = np.unique(np.concatenate([keys] + pending['keys']))
+                species = concat_matrices([species] + pending['species'])
+                if pending['aggr']:
+                    aggr_df = fold_aggregates(aggr_df, pd.concat(pending['aggr'], ignore_index=True), other_rules)
+            pending.update({'keys': [], 'species': [], 'aggr': [], 'entries': 0})
+
+        reported = 0.0
+        for chunk in chunks:
+            check_canceled(self.feedback)
+            done = min(self.progress_share - reported, self.progress_share * len(chunk) / self.point_count)
+            reported += done
+            self.report_progress('join points', done)
+            if counts is not None:
+                counts['rows'] = counts.get('rows', 0) + len(chunk)
+            chunk_species = species_matrix(chunk['id'], chunk[self.species_column])
+            pending['keys'].append(np.unique(chunk['id'].to_numpy(dtype=np.int64)))
+            pending['species'].append(chunk_species)
+            pending['entries'] += len(chunk_species['keys'])
+            if other_rules:
+                pending['aggr'].append(pd_aggr_layer(chunk, other_rules))
+            if pending['entries'] >= max(len(species['keys']), 1):
+                merge_pending()
+        merge_pending()
+
+        self.report_progress('join points', self.progress_share - reported)
+
+        cells_df = pd.DataFrame({'id': keys})
+        if aggr_df is not None:
+            cells_df = pd.merge(cells_df, aggr_df, on='id', how='left')
+        elif other_rules:
+            for field in other_rules:
+                cells_df[field] = None
+        return cells_df, species
+
+    def processing_join_chunks(self, join_layer, fields, filter_expression=None):
+        """Join a layer to the grid layer with the processing algorithm and read the result in chunks."""
+        join_result = spatial_join_two_layers(
+            self.grid_layer, join_layer, fields, filter_expression=filter_expression, feedback=self.feedback
+        )
+        for chunk in layer_chunks(join_result['OUTPUT'], ['id'] + fields, feedback=self.feedback):
+            chunk['id'] = cell_keys_from_ids(chunk['id'])
+            yield chunk
+
+    def processing_join_frame(self, join_layer, fields, filter_expression=None):
+        """Join a layer to the grid layer with the processing algorithm and read the result."""
+        join_result = spatial_join_two_layers(
+            self.grid_layer, join_layer, fields, filter_expression=filter_expression, feedback=self.feedback
+        )
+        df = vectorlayer_to_df(join_result['OUTPUT'], ['id'] + fields, fields, feedback=self.feedback)
+        df['id'] = cell_keys_from_ids(df['id'])
+        return df
 
     def finished(self, result):
+        if self.incremental:
+            end_run(self.run_key)
         if result:
+            if self.incremental:
+                remember_run(
+                    self.run_key, self.input_layers(), self.result_df,
+                    self.start_fingerprints, self.seen_edits, self.start_commits,
+                )
             QgsMessageLog.logMessage("Task completed successfully!", level=Qgis.Info)
         else:
-            QgsMessageLog.logMessage("Task failed!", level=Qgis.Warning)
+            # The edits since the last successful run stay marked dirty for the next run
+            if self.isCanceled():
+                QgsMessageLog.logMessage("Task canceled by the user.", level=Qgis.Info)
+            else:
+                QgsMessageLog.logMessage("Task failed!", level=Qgis.Warning)
 
 
-def fnf_kwaliteitsbepaling(grid_layer, polygon_layer, point_layer):
-    """Run the kwaliteitsbepaling process in a background task."""
-    species_list = load_species_list()
-    species_column_name, polygon_beheertype_name, polygon_gebied_name = load_column_settings_files()
-
+def aggregation_rules():
+    """Return the aggregation rules of the polygon and the point columns per grid cell."""
     polygon_rules = {
         'beheerType': lambda x: list(set(x.dropna())),
         'Gebied': lambda x: list(set(x.dropna()))
@@ -190,8 +691,87 @@ def fnf_kwaliteitsbepaling(grid_layer, polygon_layer, point_layer):
     point_rules = {
         'Soortnaam_NL': lambda x: list(set(x.dropna()))
     }
+    return polygon_rules, point_rules
 
-    grid_layer.removeSelection()
-
-    task = JoinAndProcessTask(grid_layer, polygon_layer, point_layer, polygon_rules, point_rules)
-    QgsApplication.taskManager().addTask(task)
+def fnf_kwaliteitsbepaling(grid_layer, polygon_layer, point_layer, begin_year=None, end_year=None,
+                           use_gpkg_sql=False, incremental=False, use_result_cache=False, profile=False):
+    """
+    Run the kwaliteitsbepaling process in a background task.
+    See kwaliteitsbepaling_task for the arguments.
+    """
+    task = kwaliteitsbepaling_task(
+        grid_layer, polygon_layer, point_layer, begin_year, end_year,
+        use_gpkg_sql=use_gpkg_sql, incremental=incremental, use_result_cache=use_result_cache, profile=profile
+    )
+    if task is not None:
+        QgsApplication.taskManager().addTask(task)
+
+def kwaliteitsbepaling_task(grid_layer, polygon_layer, point_layer, begin_year=None, end_year=None,
+                            use_gpkg_sql=False, incremental=False, use_result_cache=False, profile=False):
+    """
+    Create the task of the kwaliteitsbepaling process, or return None when the result was loaded from the cache
+    or an incremental run with the same layers and settings is still in progress.
+    Raises a ValueError when the ids of the grid layer are not 'x-y' origins of the hectare cells.
+    Pass grid_layer=None to use the implicit grid instead of joining against a grid layer.
+    Only observations dated from begin_year up to and including end_year are used.
+    With use_gpkg_sql the joins run as SQL when all layers are saved in the same GeoPackage.
+    With incremental a repeated run only recomputes the cells around the edits committed since the last run.
+    With use_result_cache a run on unchanged file based layers and settings loads the stored Grid_Combined instead.
+    With profile the run is profiled with cProfile next to its run report.
+    """
+    species_column_name, polygon_beheertype_name, polygon_gebied_name = load_column_settings_files()
+    polygon_rules, point_rules = aggregation_rules()
+
+    if grid_layer is not None:
+        grid_layer.removeSelection()
+
+    # The year window is pushed down to the provider when the observations are read
+    date_column_name = load_date_column_name()
+    point_filter = year_filter_expression(point_layer, date_column_name, begin_year, end_year)
+    if (begin_year is not None or end_year is not None) and point_filter is None:
+        QgsMessageLog.logMessage(
+            f"Date column '{date_column_name}' not found in the point layer, all observations are used.",
+            level=Qgis.Warning
+        )
+
+    # Unchanged layers and settings are served from the result cache
+    cache_key = None
+    if use_result_cache:
+        cache_key = result_cache_key(
+            [grid_layer, polygon_layer, point_layer],
+            {
+                'point_filter': point_filter,
+                'polygon_rules': sorted(polygon_rules),
+                'point_rules': sorted(point_rules),
+                'column_settings': [species_column_name, polygon_beheertype_name, polygon_gebied_name],
+                'species_tables': file_signature([BIJ12_SPECIES_FILE, BIJ12_SPECIES_XLSX, KWALITEIT_KLASSEN_FILE]),
+                'selection': sorted(polygon_layer.selectedFeatureIds()) if grid_layer is None else None,
+            },
+        )
+        cached_layer = load_cached_result(cache_key) if cache_key is not None else None
+        if cached_layer is not None:
+            QgsProject.instance().addMapLayer(cached_layer)
+            QgsMessageLog.logMessage("Grid_Combined loaded from the result cache.", level=Qgis.Info)
+            return None
+
+    # Large grids are processed in tiles to bound memory and use all cores
+    if grid_layer is not None:
+        cell_count = grid_layer.featureCount()
+    else:
+        bbox = get_bounding_box_from_selection(polygon_layer) or polygon_layer.extent()
+        extent = grid_extent(bbox)
+        cell_count = (extent.width() / CELL_SIZE) * (extent.height() / CELL_SIZE)
+    tiled = cell_count > TILED_CELL_THRESHOLD
+
+    task = JoinAndProcessTask(
+        grid_layer, polygon_layer, point_layer, polygon_rules, point_rules, tiled=tiled, point_filter=point_filter,
+        use_gpkg_sql=use_gpkg_sql, incremental=incremental, result_cache_key=cache_key, profile=profile
+    )
+    # A second run would start from the same last result and edits, so it waits for the first to finish
+    if task.incremental and not begin_run(task.run_key):
+        QgsMessageLog.logMessage(
+            "A toets with these layers and settings is still running, wait until it is finished.",
+            level=Qgis.Warning
+        )
+        return None
+    return task
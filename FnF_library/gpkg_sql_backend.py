@@ -0,0 +1,261 @@
+"""
+Optional SQL backend for input layers that live in one GeoPackage.
+
+The points are binned to grid cells inside the file, driven by the RTree spatial indexes, and only
+the distinct (cell, values) rows are read back. When SpatiaLite can be loaded the point coordinates
+are read exactly and the polygons are intersected with the grid cells in SQL as well; otherwise the
+points are placed at the middle of their RTree box and the polygons are joined in Python.
+"""
+import os
+import pathlib
+import sqlite3
+import numpy as np
+import pandas as pd
+from qgis.core import QgsProviderRegistry
+from .create_ha_polygon_layer import CELL_SIZE, cell_keys, cell_keys_from_ids, cell_keys_in_extent
+from .processing_setup import check_canceled
+
+SQL_CHUNK_SIZE = 100000  # Number of result rows fetched from the GeoPackage at a time
+CANCEL_CHECK_STEPS = 100000  # Number of SQLite instructions between cancellation checks
+
+def quote_identifier(name):
+    """Quote a table or column name for SQLite."""
+    return '"' + name.replace('"', '""') + '"'
+
+def connect(path, spatialite=False):
+    """Open the GeoPackage read-only, with SpatiaLite loaded when asked."""
+    connection = sqlite3.connect(pathlib.Path(path).as_uri() + '?mode=ro', uri=True, check_same_thread=False)
+    if spatialite:
+        connection.enable_load_extension(True)
+        connection.load_extension('mod_spatialite')
+    return connection
+
+def spatialite_available(path):
+    """Return whether SpatiaLite can be loaded into a connection to the GeoPackage."""
+    try:
+        connection = connect(path, spatialite=True)
+    except (AttributeError, sqlite3.Error):
+        # Python builds without extension loading have no enable_load_extension
+        return False
+    connection.close()
+    return True
+
+def gpkg_table(layer):
+    """
+    Describe the GeoPackage table behind a layer: its file, table, geometry and fid column,
+    RTree table and subset string. Returns None when the layer is not a GeoPackage table with
+    a spatial index, or when it has edits that are not saved to the file.
+    """
+    if layer is None or layer.providerType() != 'ogr' or layer.isModified():
+        return None
+    parts = QgsProviderRegistry.instance().decodeUri('ogr', layer.source())
+    path = parts.get('path') or ''
+    if not path.lower().endswith('.gpkg') or not os.path.exists(path):
+        return None
+
+    connection = connect(path)
+    try:
+        table = parts.get('layerName')
+        if not table:
+            tables = [
+                row[0] for row in
+                connection.execute("SELECT table_name FROM gpkg_contents WHERE data_type = 'features'")
+            ]
+            if len(tables) != 1:
+                return None
+            table = tables[0]
+        row = connection.execute(
+            "SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?", (table,)
+        ).fetchone()
+        if row is None:
+            return None
+        geometry_column = row[0]
+        rtree = f'rtree_{table}_{geometry_column}'
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (rtree,)).fetchone() is None:
+            return None
+        fid_columns = [
+            row[1] for row in connection.execute(f'PRAGMA table_info({quote_identifier(table)})') if row[5]
+        ]
+        if len(fid_columns) != 1:
+            return None
+    except sqlite3.Error:
+        return None
+    finally:
+        connection.close()
+
+    return {
+        'path': os.path.normcase(os.path.abspath(path)),
+        'table': table,
+        'geometry': geometry_column,
+        'fid': fid_columns[0],
+        'rtree': rtree,
+        'subset': layer.subsetString(),
+    }
+
+def gpkg_sources(grid_layer, polygon_layer, point_layer):
+    """
+    Describe the tables of the input layers when they all live in the same GeoPackage, in the same CRS.
+    Returns None when the SQL backend cannot be used for these layers.
+    """
+    layers = {'polygon': polygon_layer, 'point': point_layer}
+    if grid_layer is not None:
+        layers['grid'] = grid_layer
+    if len({layer.crs().authid() for layer in layers.values()}) != 1:
+        return None
+
+    tables = {name: gpkg_table(layer) for name, layer in layers.items()}
+    if any(table is None for table in tables.values()):
+        return None
+    paths = {table['path'] for table in tables.values()}
+    if len(paths) != 1:
+        return None
+
+    path = paths.pop()
+    sources = {'path': path, 'spatialite': spatialite_available(path)}
+    sources.update(tables)
+    return sources
+
+def table_subquery(table, columns, conditions=()):
+    """SQL for the given columns of a table, filtered by its subset string and the extra conditions."""
+    conditions = [condition for condition in (table['subset'], *conditions) if condition]
+    query = f"SELECT {', '.join(columns)} FROM {quote_identifier(table['table'])}"
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(f'({condition})' for condition in conditions)
+    return f'({query})'
+
+def extent_condition(alias, extent):
+    """SQL condition on the RTree rows with the given alias overlapping the extent."""
+    return (
+        f'{alias}.maxx >= {float(extent.xMinimum())!r} AND {alias}.minx <= {float(extent.xMaximum())!r} '
+        f'AND {alias}.maxy >= {float(extent.yMinimum())!r} AND {alias}.miny <= {float(extent.yMaximum())!r}'
+    )
+
+def floor_division(expression, size=CELL_SIZE):
+    """SQL for the floor of expression / size, also for negative values."""
+    truncated = f'CAST(({expression}) / {size} AS INTEGER)'
+    return f'({truncated} - (({expression}) < {truncated} * {size}))'
+
+def fetch_chunks(connection, query, chunk_size=SQL_CHUNK_SIZE, feedback=None):
+    """
+    Run a query and yield its rows in lists of at most chunk_size rows, closing the connection at the end.
+    A canceled feedback interrupts the query, also while SQLite is still working towards the first row.
+    """
+    if feedback is not None:
+        connection.set_progress_handler(feedback.isCanceled, CANCEL_CHECK_STEPS)
+    try:
+        cursor = connection.execute(query)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    except sqlite3.OperationalError:
+        check_canceled(feedback)
+        raise
+    finally:
+        connection.close()
+
+def gpkg_point_chunks(sources, fields, extent=None, filter_expression=None, chunk_size=SQL_CHUNK_SIZE,
+                      feedback=None):
+    """
+    Bin the points inside the extent to grid cells in SQL and yield the distinct (cell, field values)
+    rows in chunks, as DataFrames with the cell key as 'id'. Without a grid table the cell follows from
+    the point coordinates, otherwise it is the grid cell whose box contains the point.
+    The filter expression must be plain SQL on the point columns, like the year window.
+    """
+    point = sources['point']
+    point_columns = [quote_identifier(point['fid'])] + [quote_identifier(field) for field in fields]
+    if sources['spatialite']:
+        point_columns.append(quote_identifier(point['geometry']))
+        geometry = f"GeomFromGPB(p.{quote_identifier(point['geometry'])})"
+        x, y = f'ST_X({geometry})', f'ST_Y({geometry})'
+    else:
+        # The RTree holds the point as a float32 box rounded outwards, its middle is the point
+        x, y = '((rp.minx + rp.maxx) / 2)', '((rp.miny + rp.maxy) / 2)'
+
+    point_join = (
+        f"{quote_identifier(point['rtree'])} rp "
+        f"JOIN {table_subquery(point, point_columns, [filter_expression])} p "
+        f"ON p.{quote_identifier(point['fid'])} = rp.id"
+    )
+    values = ', '.join(f'p.{quote_identifier(field)}' for field in fields)
+    where = f' WHERE {extent_condition("rp", extent)}' if extent is not None else ''
+
+    if 'grid' in sources:
+        grid = sources['grid']
+        grid_table = table_subquery(grid, [quote_identifier(grid['fid']), '"id"'])
+        query = (
+            f'SELECT DISTINCT g."id", {values} FROM {point_join} '
+            f"JOIN {quote_identifier(grid['rtree'])} rg "
+            f'ON rg.minx <= {x} AND rg.maxx >= {x} AND rg.miny <= {y} AND rg.maxy >= {y} '
+            f"JOIN {grid_table} g ON g.{quote_identifier(grid['fid'])} = rg.id{where}"
+        )
+    else:
+        query = f'SELECT DISTINCT {floor_division(x)}, {floor_division(y)}, {values} FROM {point_join}{where}'
+
+    connection = connect(sources['path'], sources['spatialite'])
+    for rows in fetch_chunks(connection, query, chunk_size, feedback):
+        if 'grid' in sources:
+            df = pd.DataFrame(rows, columns=['id'] + fields)
+            df['id'] = cell_keys_from_ids(df['id'])
+        else:
+            df = pd.DataFrame(rows, columns=['col', 'row'] + fields)
+            keys = cell_keys(df.pop('col').to_numpy(dtype=np.int64) * CELL_SIZE,
+                             df.pop('row').to_numpy(dtype=np.int64) * CELL_SIZE)
+            df.insert(0, 'id', keys)
+            if extent is not None:
+                df = df[cell_keys_in_extent(df['id'], extent)].reset_index(drop=True)
+        yield df
+
+def gpkg_grid_cell_keys(sources, extent=None, feedback=None):
+    """Return the keys of the grid cells overlapping the extent (or all cells)."""
+    grid = sources['grid']
+    grid_table = table_subquery(grid, [quote_identifier(grid['fid']), '"id"'])
+    query = (
+        f'SELECT g."id" FROM {quote_identifier(grid["rtree"])} rg '
+        f'JOIN {grid_table} g ON g.{quote_identifier(grid["fid"])} = rg.id'
+    )
+    if extent is not None:
+        query += f' WHERE {extent_condition("rg", extent)}'
+    connection = connect(sources['path'])
+    ids = [row[0] for rows in fetch_chunks(connection, query, feedback=feedback) for row in rows]
+    return cell_keys_from_ids(ids)
+
+def gpkg_polygon_cells(sources, fields, extent=None, feedback=None):
+    """
+    Intersect the polygons with the grid cells in SQL (SpatiaLite required). Returns a DataFrame with
+    the cell key as 'id' and the polygon fields, one row per intersecting pair and a row with empty
+    values for cells without a polygon. With an extent only the cells inside it are returned.
+    """
+    grid = sources['grid']
+    polygon = sources['polygon']
+    grid_columns = [quote_identifier(grid['fid']), '"id"', quote_identifier(grid['geometry'])]
+    polygon_columns = (
+        [quote_identifier(polygon['fid']), quote_identifier(polygon['geometry'])]
+        + [quote_identifier(field) for field in fields]
+    )
+    query = (
+        f'SELECT g."id", {", ".join(f"p.{quote_identifier(field)}" for field in fields)} '
+        f"FROM {quote_identifier(grid['rtree'])} rg "
+        f"JOIN {table_subquery(grid, grid_columns)} g ON g.{quote_identifier(grid['fid'])} = rg.id "
+        f"JOIN {quote_identifier(polygon['rtree'])} rp "
+        f'ON rp.maxx >= rg.minx AND rp.minx <= rg.maxx AND rp.maxy >= rg.miny AND rp.miny <= rg.maxy '
+        f"JOIN {table_subquery(polygon, polygon_columns)} p ON p.{quote_identifier(polygon['fid'])} = rp.id "
+        f"WHERE ST_Intersects(GeomFromGPB(g.{quote_identifier(grid['geometry'])}), "
+        f"GeomFromGPB(p.{quote_identifier(polygon['geometry'])}))"
+    )
+    if extent is not None:
+        query += f' AND {extent_condition("rg", extent)}'
+
+    connection = connect(sources['path'], spatialite=True)
+    rows = [row for chunk in fetch_chunks(connection, query, feedback=feedback) for row in chunk]
+    df = pd.DataFrame(rows, columns=['id'] + fields)
+    df['id'] = cell_keys_from_ids(df['id'])
+
+    # Cells without a polygon get one row with empty values
+    unmatched = np.setdiff1d(gpkg_grid_cell_keys(sources, extent, feedback), df['id'].to_numpy(dtype=np.int64))
+    if len(unmatched):
+        df = pd.concat([df, pd.DataFrame({'id': unmatched})], ignore_index=True)
+    if extent is not None:
+        df = df[cell_keys_in_extent(df['id'], extent)].reset_index(drop=True)
+    return df
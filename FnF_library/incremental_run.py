@@ -0,0 +1,240 @@
+"""
+State for incremental re-runs of the kwaliteitsbepaling.
+
+The per-cell result of the last run is kept per combination of input layers and settings. Edits
+committed to those layers mark the area they touch as dirty, so the next run only recomputes the
+tiles of cells around the edits. Changes the edit signals do not see (another program writing the
+file, a changed subset string) show up as a changed layer fingerprint and lead to a full run.
+The edits are only forgotten once a run that saw them has finished, and only one run per key can
+be in progress at a time. The results of the INCREMENTAL_MAX_RUNS most recent keys are kept.
+"""
+import threading
+import numpy as np
+import pandas as pd
+from qgis.core import QgsFeatureRequest
+from .create_ha_polygon_layer import CELL_SIZE, tile_extents, cell_keys_in_extent
+from .result_cache import layer_file_path, file_state
+
+INCREMENTAL_TILE_CELLS = 10  # Dirty cells are recomputed per tile of 10x10 cells (1x1 km)
+INCREMENTAL_MAX_RUNS = 3  # Number of run keys whose result is kept, least recently used are dropped
+
+# Run state per run key, in order of use, and the keys with a run in progress; only touched from the main thread
+run_states = {}
+running_keys = set()
+
+def run_key(grid_layer, polygon_layer, point_layer, *settings):
+    """Key of a run: the ids of the input layers and the settings that change the result."""
+    layer_ids = tuple(layer.id() if layer is not None else None for layer in (grid_layer, polygon_layer, point_layer))
+    return layer_ids + settings
+
+def layer_fingerprint(layer):
+    """
+    Summarize the state of a layer that is known without reading its features, including the
+    modification time and size of the file behind it, which change when another program writes it.
+    """
+    path = layer_file_path(layer)
+    return (
+        layer.source(),
+        layer.subsetString(),
+        layer.featureCount(),
+        layer.extent().toString(),
+        tuple(tuple(state) for state in file_state(path)) if path is not None else None,
+    )
+
+def changed_feature_extents(layer):
+    """
+    Return the bounding boxes of the features touched by the pending edits of a layer: the saved
+    geometry of deleted and changed features and the new geometry of added and changed features.
+    """
+    edit_buffer = layer.editBuffer()
+    if edit_buffer is None:
+        return []
+
+    changed_geometries = edit_buffer.changedGeometries()
+    saved_ids = (
+        set(edit_buffer.deletedFeatureIds())
+        | set(changed_geometries.keys())
+        | set(edit_buffer.changedAttributeValues().keys())
+    )
+    # Features added in this edit session have negative ids and no saved geometry
+    saved_ids = [fid for fid in saved_ids if fid >= 0]
+
+    extents = []
+    if saved_ids:
+        request = QgsFeatureRequest().setFilterFids(saved_ids).setNoAttributes()
+        for feature in layer.dataProvider().getFeatures(request):
+            if feature.hasGeometry():
+                extents.append(feature.geometry().boundingBox())
+    for feature in edit_buffer.addedFeatures().values():
+        if feature.hasGeometry():
+            extents.append(feature.geometry().boundingBox())
+    for geometry in changed_geometries.values():
+        if not geometry.isEmpty():
+            extents.append(geometry.boundingBox())
+    return extents
+
+def rectangles_to_array(rectangles):
+    """Return the bounds of the rectangles as an (n, 4) array of xmin, ymin, xmax, ymax."""
+    return np.array(
+        [[r.xMinimum(), r.yMinimum(), r.xMaximum(), r.yMaximum()] for r in rectangles], dtype=np.float64
+    ).reshape(-1, 4)
+
+
+class RunState:
+    """
+    The result of the last run for one run key, and the areas edited since. The fingerprints are
+    those of the layers when that run started, changes made while it ran lead to a full run.
+    """
+    def __init__(self, layers, result_df, fingerprints):
+        self.layers = layers
+        self.result_df = result_df
+        self.dirty_extents = []
+        self.lock = threading.Lock()
+        self.fingerprints = dict(fingerprints)
+        # Number of commits seen per layer id, to tell which fingerprints moved on during a run
+        self.commit_counts = dict.fromkeys(fingerprints, 0)
+        self.handlers = []
+        for layer in layers:
+            before_commit = lambda *args, layer=layer: self.mark_dirty(layer)
+            after_commit = lambda *args, layer=layer: self.refresh_fingerprint(layer)
+            layer.beforeCommitChanges.connect(before_commit)
+            layer.afterCommitChanges.connect(after_commit)
+            self.handlers.append((layer, before_commit, after_commit))
+
+    def disconnect(self):
+        """Stop listening to the edits of the layers."""
+        for layer, before_commit, after_commit in self.handlers:
+            try:
+                layer.beforeCommitChanges.disconnect(before_commit)
+                layer.afterCommitChanges.disconnect(after_commit)
+            except (RuntimeError, TypeError):
+                # The layer was already deleted
+                pass
+        self.handlers = []
+
+    def mark_dirty(self, layer):
+        """Remember the area touched by the edits the layer is about to commit."""
+        extents = changed_feature_extents(layer)
+        with self.lock:
+            self.dirty_extents.extend(extents)
+
+    def refresh_fingerprint(self, layer):
+        """Accept the state of the layer after a commit whose edits were marked dirty."""
+        with self.lock:
+            self.fingerprints[layer.id()] = layer_fingerprint(layer)
+            self.commit_counts[layer.id()] = self.commit_counts.get(layer.id(), 0) + 1
+
+    def commits(self):
+        """Return the number of commits seen per layer id so far."""
+        with self.lock:
+            return dict(self.commit_counts)
+
+    def reset_fingerprints(self, start_fingerprints, start_commits):
+        """
+        Go back to the fingerprints of a finished run as it started, except for the layers with a
+        commit since, whose fingerprint was moved on by that commit. Other changes made during the
+        run then still lead to a full next run.
+        """
+        with self.lock:
+            for layer_id, fingerprint in start_fingerprints.items():
+                if self.commit_counts.get(layer_id, 0) == start_commits.get(layer_id, 0):
+                    self.fingerprints[layer_id] = fingerprint
+
+    def is_current(self):
+        """Return whether all changes to the layers since the last run were seen as committed edits."""
+        try:
+            return all(layer_fingerprint(layer) == self.fingerprints.get(layer.id()) for layer in self.layers)
+        except RuntimeError:
+            # One of the layers was deleted
+            return False
+
+    def dirty_tiles(self, cell_extent):
+        """
+        Return the tiles of the grid with cells around the edits since the last run, or None when the
+        layers changed in another way and a full run is needed, together with the number of edits seen.
+        The edits are kept until forget_edits is called for a finished run.
+        """
+        with self.lock:
+            extents = list(self.dirty_extents)
+        if not self.is_current():
+            return None, len(extents)
+
+        tiles = tile_extents(cell_extent.buffered(CELL_SIZE), INCREMENTAL_TILE_CELLS)
+        if not extents or not tiles:
+            return [], len(extents)
+        # One cell around every edit, for the vogels territorium of the neighboring cells
+        edits = rectangles_to_array(extents)
+        edits[:, :2] -= CELL_SIZE
+        edits[:, 2:] += CELL_SIZE
+        bounds = rectangles_to_array(tiles)
+        dirty = np.zeros(len(tiles), dtype=bool)
+        for x_min, y_min, x_max, y_max in edits:
+            dirty |= (
+                (bounds[:, 0] < x_max) & (bounds[:, 2] > x_min)
+                & (bounds[:, 1] < y_max) & (bounds[:, 3] > y_min)
+            )
+        return [tile for tile, is_dirty in zip(tiles, dirty.tolist()) if is_dirty], len(extents)
+
+    def forget_edits(self, count):
+        """Forget the first count edits, seen by a finished run; edits committed while it ran are kept."""
+        with self.lock:
+            del self.dirty_extents[:count]
+
+    def updated_result(self, updated_df, tiles):
+        """Return the last result with the cells of the recomputed tiles replaced by updated_df."""
+        keys = self.result_df['id'].to_numpy(dtype=np.int64)
+        stale = np.zeros(len(keys), dtype=bool)
+        for tile in tiles:
+            stale |= cell_keys_in_extent(keys, tile)
+        frames = [self.result_df[~stale]]
+        if updated_df is not None:
+            frames.append(updated_df)
+        return pd.concat(frames, ignore_index=True).sort_values('id', ignore_index=True)
+
+
+def run_state(key):
+    """Return the state of the last run with this key, or None."""
+    return run_states.get(key)
+
+def begin_run(key):
+    """Mark a run with this key as in progress. Returns False when one is in progress already."""
+    if key in running_keys:
+        return False
+    running_keys.add(key)
+    return True
+
+def end_run(key):
+    """Mark the run with this key as no longer in progress."""
+    running_keys.discard(key)
+
+def layer_fingerprints(layers):
+    """Fingerprint the layers of a run as it starts, by layer id."""
+    return {layer.id(): layer_fingerprint(layer) for layer in layers}
+
+def remember_run(key, layers, result_df, start_fingerprints, seen_edits=0, start_commits=None):
+    """
+    Keep the result of a finished run and forget the seen_edits edits it was started with; edits
+    committed while it ran stay marked dirty. start_commits are the commit counts of the state
+    the run started from. The state of the least recently used keys is dropped.
+    """
+    state = run_states.pop(key, None)
+    if state is None:
+        state = RunState(layers, result_df, start_fingerprints)
+    else:
+        state.result_df = result_df
+        state.forget_edits(seen_edits)
+        state.reset_fingerprints(start_fingerprints, start_commits or {})
+    run_states[key] = state
+    for old_key in list(run_states)[:-INCREMENTAL_MAX_RUNS]:
+        forget_run(old_key)
+
+def forget_run(key):
+    """Drop the state of a run, so the next run with this key is a full run."""
+    state = run_states.pop(key, None)
+    if state is not None:
+        state.disconnect()
+
+def forget_all_runs():
+    """Drop the state of all runs and stop listening to the edits of their layers."""
+    for key in list(run_states):
+        forget_run(key)
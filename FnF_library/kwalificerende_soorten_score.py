@@ -0,0 +1,161 @@
+import os
+import numpy as np
+import pandas as pd
+from .species_tables import (
+    BIJ12_SPECIES_FILE,
+    KWALITEIT_KLASSEN_FILE,
+    relation_table_view,
+    build_species_by_beheertype,
+)
+from .cell_species_matrix import lowercase_species
+
+KWALITEIT_KLASSEN_COLUMNS = ['Beheertype', 'kwaliteit', 'minimum_soorten']
+
+def build_incidence(table):
+    """Build the species codes, beheertype codes and the beheertype x species incidence matrix."""
+    species_by_beheertype = build_species_by_beheertype(table)
+    beheertypes = sorted(species_by_beheertype)
+    species = sorted(set().union(*species_by_beheertype.values())) if beheertypes else []
+
+    species_codes = {name: code for code, name in enumerate(species)}
+    beheertype_codes = {beheertype: code for code, beheertype in enumerate(beheertypes)}
+    incidence = np.zeros((len(beheertypes), len(species)), dtype=bool)
+    for beheertype, names in species_by_beheertype.items():
+        incidence[beheertype_codes[beheertype], [species_codes[name] for name in names]] = True
+    return {
+        'species_codes': species_codes,
+        'beheertype_codes': beheertype_codes,
+        'beheertypes': np.array(beheertypes, dtype=object),
+        'species': np.array(species, dtype=object),
+        'incidence': incidence,
+    }
+
+def species_beheertype_incidence():
+    """Return the cached incidence matrix of qualifying species per beheertype."""
+    return relation_table_view(BIJ12_SPECIES_FILE, ',', 'incidence', build_incidence)
+
+def cell_code_pairs(df, column, codes):
+    """Explode a list column into unique (row, code) pairs, dropping values without a code."""
+    exploded = df[column].explode()
+    exploded = exploded[exploded.map(lambda value: isinstance(value, str))]
+    pairs = pd.DataFrame({
+        'row': exploded.index.to_numpy(),
+        'code': exploded.map(codes).to_numpy(),
+    }).dropna().drop_duplicates()
+    return pairs['row'].to_numpy(dtype=np.int64), pairs['code'].to_numpy(dtype=np.int64)
+
+def species_code_pairs(df, species, codes):
+    """Turn the entries of a species matrix into (row, code) pairs for the cells in df."""
+    species = lowercase_species(species)
+    # Only the species names are looked up, not every entry
+    name_codes = pd.Series(species['species'], dtype=object).map(codes).fillna(-1).to_numpy(dtype=np.int64)
+    entry_codes = name_codes[species['codes']] if len(name_codes) else np.array([], dtype=np.int64)
+
+    positions = pd.Series(np.arange(len(df)), index=df['id'].to_numpy())
+    positions = positions[~positions.index.duplicated()]
+    rows = positions.reindex(species['keys']).fillna(-1).to_numpy(dtype=np.int64)
+
+    keep = (entry_codes >= 0) & (rows >= 0)
+    return rows[keep], entry_codes[keep]
+
+def build_kwaliteit_klassen(table):
+    """Build the class limits view: one row per beheertype and class, sorted by the minimum number of species."""
+    table = table[KWALITEIT_KLASSEN_COLUMNS].dropna()
+    return pd.DataFrame({
+        'beheertype': table['Beheertype'].astype(str),
+        'kwaliteit': table['kwaliteit'].astype(str),
+        'minimum': table['minimum_soorten'].astype(np.int64),
+    }).sort_values('minimum', ignore_index=True)
+
+def kwaliteit_klassen():
+    """Return the cached class limits per beheertype, or None when the relation table is not there."""
+    if not os.path.exists(KWALITEIT_KLASSEN_FILE):
+        return None
+    return relation_table_view(KWALITEIT_KLASSEN_FILE, ',', 'klassen', build_kwaliteit_klassen)
+
+def values_per_row(rows, values, row_count):
+    """Split the values of (row, value) pairs into one array per row 0..row_count-1, empty for rows without pairs."""
+    if row_count == 0:
+        return []
+    rows = np.asarray(rows, dtype=np.int64)
+    order = np.argsort(rows, kind='stable')
+    return np.split(np.asarray(values)[order], np.searchsorted(rows[order], np.arange(1, row_count)))
+
+def dicts_per_row(rows, keys, values, row_count):
+    """Collect (row, key, value) triples into one dict per row, None for rows without triples."""
+    return [
+        dict(zip(row_keys.tolist(), row_values.tolist())) if len(row_keys) else None
+        for row_keys, row_values in zip(
+            values_per_row(rows, keys, row_count), values_per_row(rows, values, row_count)
+        )
+    ]
+
+def kwaliteit_per_beheertype(counts, klassen):
+    """
+    Look up the class of every (row, beheertype, aantal) count: the class with the highest minimum
+    not above the count, for the same beheertype. Counts without a matching class are dropped.
+    """
+    classified = pd.merge_asof(
+        counts.sort_values('aantal'),
+        klassen,
+        left_on='aantal',
+        right_on='minimum',
+        by='beheertype',
+        direction='backward',
+    )
+    return classified.dropna(subset=['kwaliteit'])
+
+def score_cells(df, beheertype_column, species):
+    """
+    Score every cell: count the species in the species matrix that qualify for each beheertype
+    listed for the cell in df. Adds the columns 'kwalificerende_soorten', 'aantal_per_beheertype'
+    and 'aantal_kwalificerend' (best beheertype). When the class limits per beheertype are in the
+    relation tables, 'kwaliteit_per_beheertype' holds the quality class per beheertype as well.
+    """
+    incidence = species_beheertype_incidence()
+    df = df.reset_index(drop=True)
+
+    bt_rows, bt_codes = cell_code_pairs(df, beheertype_column, incidence['beheertype_codes'])
+    sp_rows, sp_codes = species_code_pairs(df, species, incidence['species_codes'])
+
+    # All (cell, beheertype, species) combinations of a cell, kept where the species qualifies
+    triples = pd.merge(
+        pd.DataFrame({'row': bt_rows, 'beheertype': bt_codes}),
+        pd.DataFrame({'row': sp_rows, 'species': sp_codes}),
+        on='row',
+    )
+    qualifies = incidence['incidence'][triples['beheertype'].to_numpy(), triples['species'].to_numpy()]
+    triples = triples[qualifies]
+
+    per_beheertype = triples.groupby(['row', 'beheertype']).size().reset_index(name='aantal')
+    per_beheertype['beheertype'] = incidence['beheertypes'][per_beheertype['beheertype'].to_numpy()]
+
+    aantal_kwalificerend = np.zeros(len(df), dtype=np.int64)
+    best = per_beheertype.groupby('row')['aantal'].max()
+    aantal_kwalificerend[best.index.to_numpy()] = best.to_numpy()
+
+    species_rows = triples.drop_duplicates(['row', 'species'])
+    df['kwalificerende_soorten'] = [
+        names.tolist() for names in values_per_row(
+            species_rows['row'], incidence['species'][species_rows['species'].to_numpy()], len(df)
+        )
+    ]
+    df['aantal_per_beheertype'] = dicts_per_row(
+        per_beheertype['row'], per_beheertype['beheertype'], per_beheertype['aantal'], len(df)
+    )
+    df['aantal_kwalificerend'] = aantal_kwalificerend
+
+    klassen = kwaliteit_klassen()
+    if klassen is not None:
+        # Beheertypes of a cell without qualifying species are classified with a count of 0
+        counts = pd.merge(
+            pd.DataFrame({'row': bt_rows, 'beheertype': incidence['beheertypes'][bt_codes]}).drop_duplicates(),
+            per_beheertype,
+            on=['row', 'beheertype'],
+            how='left',
+        ).fillna({'aantal': 0}).astype({'aantal': np.int64, 'beheertype': str})
+        classified = kwaliteit_per_beheertype(counts, klassen)
+        df['kwaliteit_per_beheertype'] = dicts_per_row(
+            classified['row'], classified['beheertype'], classified['kwaliteit'], len(df)
+        )
+    return df
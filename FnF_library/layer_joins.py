@@ -0,0 +1,316 @@
+"""
+Readers and spatial joins of the input layers.
+
+The points are read in chunks, binned to the implicit grid by their coordinates or joined to the
+cells of a grid layer through a spatial index. The polygons are joined to the cells they intersect.
+Every reader returns DataFrames with the int64 cell key as 'id' and stops at the next feature when
+the feedback is canceled.
+"""
+import numpy as np
+import pandas as pd
+from qgis.core import (
+    QgsSpatialIndex,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsProcessingFeatureSourceDefinition,
+)
+from PyQt5.QtCore import QVariant
+import processing
+from .processing_setup import processing_algorithm, check_canceled, JOIN_BY_LOCATION_ALGORITHM
+from .create_ha_polygon_layer import (
+    cell_origins_from_coordinates,
+    cell_keys,
+    cell_keys_from_ids,
+    cell_keys_in_extent,
+    polygon_cell_pairs,
+)
+
+POINT_CHUNK_SIZE = 100000  # Number of observations read before they are folded into the cell aggregates
+
+def spatial_join_two_layers(target_layer, join_layer, joining_fields, selection_only= False, filter_expression=None,
+                            feedback=None):
+    """
+    Perform a spatial join between two QGIS vector layers using 'native:joinattributesbylocation'.
+    With a filter expression only the matching join features are used.
+    The feedback is passed on to the algorithm, so a canceled task also stops the join.
+    """
+    if not target_layer or not join_layer:
+        raise ValueError("One or both input layers are invalid.")
+
+    if filter_expression:
+        # Copy the matching features only, the provider evaluates the filter
+        request = QgsFeatureRequest().setFilterExpression(filter_expression)
+        if selection_only:
+            request.setFilterFids(join_layer.selectedFeatureIds())
+        join_source = join_layer.materialize(request)
+    else:
+        join_source = QgsProcessingFeatureSourceDefinition(
+            join_layer.id(),
+            selectedFeaturesOnly=selection_only,
+        )
+
+    params = {
+        'INPUT': QgsProcessingFeatureSourceDefinition(
+            target_layer.id(),
+            selectedFeaturesOnly=False,
+        ),
+        'JOIN': join_source,
+        'PREDICATE': [0],
+        'JOIN_FIELDS': joining_fields,
+        'METHOD': 0,
+        'DISCARD_NONMATCHING': False,
+        'OUTPUT': 'memory:',
+    }
+
+    result = processing.run(processing_algorithm(JOIN_BY_LOCATION_ALGORITHM), params, feedback=feedback)
+    check_canceled(feedback)
+
+    return result
+
+
+def index_join_two_layers(target_layer, join_layer, joining_fields, selection_only=False, extent=None,
+                          filter_expression=None, feedback=None):
+    """
+    Perform a spatial join between two QGIS vector layers in-process, using one QgsSpatialIndex
+    over the join layer. Returns a DataFrame with the target cell key as 'id' and the joined fields,
+    one row per intersecting pair and a row with empty values for targets without a match.
+    With an extent only the features around it are read and only the cells inside it are returned.
+    A filter expression is passed on to the provider when reading the join layer.
+    Stops at the next feature when the feedback is canceled.
+    """
+    if not target_layer or not join_layer:
+        raise ValueError("One or both input layers are invalid.")
+
+    index = QgsSpatialIndex(QgsSpatialIndex.FlagStoreFeatureGeometries)
+    attributes = {}
+    join_request = QgsFeatureRequest().setSubsetOfAttributes(joining_fields, join_layer.fields())
+    if extent is not None:
+        join_request.setFilterRect(extent)
+    if filter_expression:
+        join_request.setFilterExpression(filter_expression)
+    if selection_only:
+        join_features = join_layer.getSelectedFeatures(join_request)
+    else:
+        join_features = join_layer.getFeatures(join_request)
+    for feature in join_features:
+        check_canceled(feedback)
+        if not feature.hasGeometry():
+            continue
+        index.addFeature(feature)
+        attributes[feature.id()] = [null_to_none(feature[field]) for field in joining_fields]
+
+    columns = {'id': []}
+    columns.update({field: [] for field in joining_fields})
+    no_match = [[None] * len(joining_fields)]
+
+    target_request = QgsFeatureRequest().setSubsetOfAttributes(['id'], target_layer.fields())
+    if extent is not None:
+        target_request.setFilterRect(extent)
+    for target in target_layer.getFeatures(target_request):
+        check_canceled(feedback)
+        geom = target.geometry()
+        matches = []
+        if not geom.isEmpty():
+            candidates = index.intersects(geom.boundingBox())
+            if candidates:
+                engine = QgsGeometry.createGeometryEngine(geom.constGet())
+                engine.prepareGeometry()
+                matches = [
+                    attributes[fid] for fid in candidates
+                    if engine.intersects(index.geometry(fid).constGet())
+                ]
+
+        target_id = target['id']
+        for values in matches or no_match:
+            columns['id'].append(target_id)
+            for field, value in zip(joining_fields, values):
+                columns[field].append(value)
+
+    columns['id'] = cell_keys_from_ids(columns['id'])
+    df = pd.DataFrame(columns)
+    if extent is not None:
+        df = df[cell_keys_in_extent(df['id'], extent)].reset_index(drop=True)
+    return categorize_columns(df, joining_fields)
+
+
+def null_to_none(value):
+    """Turn a QGIS NULL attribute value into None so pandas treats it as missing."""
+    if isinstance(value, QVariant) and value.isNull():
+        return None
+    return value
+
+
+def categorize_columns(df, fields):
+    """Store the text columns among the given fields as pandas categoricals."""
+    for field in fields:
+        if field in df.columns and (
+            pd.api.types.is_object_dtype(df[field]) or pd.api.types.is_string_dtype(df[field])
+        ):
+            df[field] = df[field].astype('category')
+    return df
+
+
+def vectorlayer_to_df(vectorlayer, fields=None, categorical_fields=(), feedback=None):
+    """
+    Convert a QGIS vector layer to a pandas DataFrame.
+    Only the given fields (default all) are requested, geometry is skipped and the values are
+    collected per column so the DataFrame is built in one go.
+    """
+    if not vectorlayer.isValid():
+        raise ValueError("Invalid vector layer.")
+    if fields is None:
+        fields = [field.name() for field in vectorlayer.fields()]
+    field_indexes = [vectorlayer.fields().indexOf(field) for field in fields]
+
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(field_indexes)
+
+    columns = [[] for _ in fields]
+    for feature in vectorlayer.getFeatures(request):
+        check_canceled(feedback)
+        attributes = feature.attributes()
+        for column, field_index in zip(columns, field_indexes):
+            column.append(null_to_none(attributes[field_index]))
+
+    df = pd.DataFrame(dict(zip(fields, columns)), columns=fields)
+    return categorize_columns(df, categorical_fields)
+
+
+def point_request(point_layer, fields, extent=None, filter_expression=None):
+    """Build the feature request for reading the given fields of the points inside the extent."""
+    request = QgsFeatureRequest().setSubsetOfAttributes(fields, point_layer.fields())
+    if extent is not None:
+        request.setFilterRect(extent)
+    if filter_expression:
+        request.setFilterExpression(filter_expression)
+    return request
+
+
+def binned_points_frame(xs, ys, columns, extent=None):
+    """Build a DataFrame of point values with the cell key of their coordinates as 'id'."""
+    df = pd.DataFrame(columns)
+    df.insert(0, 'id', cell_keys(*cell_origins_from_coordinates(xs, ys)))
+    if extent is not None:
+        df = df[cell_keys_in_extent(df['id'], extent)].reset_index(drop=True)
+    return df
+
+
+def bin_point_chunks(point_layer, fields, extent=None, filter_expression=None, chunk_size=POINT_CHUNK_SIZE,
+                     feedback=None):
+    """
+    Read the point observations in chunks of chunk_size features and yield each chunk as a
+    DataFrame with the cell key of the point coordinates as 'id'.
+    Points outside the extent or not matching the filter expression are skipped.
+    """
+    request = point_request(point_layer, fields, extent, filter_expression)
+
+    xs, ys = [], []
+    columns = {field: [] for field in fields}
+    for feature in point_layer.getFeatures(request):
+        check_canceled(feedback)
+        geom = feature.geometry()
+        if geom.isEmpty():
+            continue
+        point = geom.vertexAt(0)
+        xs.append(point.x())
+        ys.append(point.y())
+        for field in fields:
+            columns[field].append(null_to_none(feature[field]))
+        if len(xs) >= chunk_size:
+            yield binned_points_frame(xs, ys, columns, extent)
+            xs, ys = [], []
+            columns = {field: [] for field in fields}
+    if xs:
+        yield binned_points_frame(xs, ys, columns, extent)
+
+
+def grid_cell_index(grid_layer, extent=None, feedback=None):
+    """
+    Build a spatial index over the grid cells inside the extent (or all cells).
+    Returns the index and the cell key of every indexed feature id.
+    """
+    index = QgsSpatialIndex(QgsSpatialIndex.FlagStoreFeatureGeometries)
+    request = QgsFeatureRequest().setSubsetOfAttributes(['id'], grid_layer.fields())
+    if extent is not None:
+        request.setFilterRect(extent)
+    fids, ids = [], []
+    for cell in grid_layer.getFeatures(request):
+        check_canceled(feedback)
+        if not cell.hasGeometry():
+            continue
+        index.addFeature(cell)
+        fids.append(cell.id())
+        ids.append(cell['id'])
+    return index, dict(zip(fids, cell_keys_from_ids(ids).tolist()))
+
+
+def join_point_chunks(grid_index, cell_key_by_fid, point_layer, fields, extent=None, filter_expression=None,
+                      chunk_size=POINT_CHUNK_SIZE, feedback=None):
+    """
+    Read the point observations in chunks and yield each chunk as a DataFrame with the key of every
+    grid cell of the index they intersect as 'id', one row per point and cell.
+    """
+    request = point_request(point_layer, fields, extent, filter_expression)
+
+    keys = []
+    columns = {field: [] for field in fields}
+    for feature in point_layer.getFeatures(request):
+        check_canceled(feedback)
+        geom = feature.geometry()
+        if geom.isEmpty():
+            continue
+        values = [null_to_none(feature[field]) for field in fields]
+        for fid in grid_index.intersects(geom.boundingBox()):
+            if not grid_index.geometry(fid).intersects(geom):
+                continue
+            keys.append(cell_key_by_fid[fid])
+            for field, value in zip(fields, values):
+                columns[field].append(value)
+        if len(keys) >= chunk_size:
+            yield pd.DataFrame({'id': np.asarray(keys, dtype=np.int64), **columns})
+            keys = []
+            columns = {field: [] for field in fields}
+    if keys:
+        yield pd.DataFrame({'id': np.asarray(keys, dtype=np.int64), **columns})
+
+
+def layer_chunks(vectorlayer, fields, chunk_size=POINT_CHUNK_SIZE, feedback=None):
+    """Read the given fields of a vector layer, without geometry, as DataFrames of chunk_size rows."""
+    field_indexes = [vectorlayer.fields().indexOf(field) for field in fields]
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(field_indexes)
+
+    columns = [[] for _ in fields]
+    for feature in vectorlayer.getFeatures(request):
+        check_canceled(feedback)
+        attributes = feature.attributes()
+        for column, field_index in zip(columns, field_indexes):
+            column.append(null_to_none(attributes[field_index]))
+        if len(columns[0]) >= chunk_size:
+            yield pd.DataFrame(dict(zip(fields, columns)), columns=fields)
+            columns = [[] for _ in fields]
+    if columns and columns[0]:
+        yield pd.DataFrame(dict(zip(fields, columns)), columns=fields)
+
+
+def polygon_cells_to_df(polygon_layer, fields, feature_ids=None, extent=None, feedback=None):
+    """
+    List the polygon attributes for every grid cell intersecting the given (or all) polygons.
+    With an extent only the cells inside it are returned.
+    """
+    request = QgsFeatureRequest()
+    if feature_ids:
+        request.setFilterFids(feature_ids)
+    if extent is not None:
+        request.setFilterRect(extent)
+    features = list(polygon_layer.getFeatures(request))
+    attributes = {
+        feature.id(): [null_to_none(feature[field]) for field in fields] for feature in features
+    }
+
+    xs, ys, fids = polygon_cell_pairs(features, feedback=feedback, cell_extent=extent)
+    df = pd.DataFrame([attributes[fid] for fid in fids.tolist()], columns=fields)
+    df.insert(0, 'id', cell_keys(xs, ys))
+    return categorize_columns(df, fields)
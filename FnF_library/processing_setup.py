@@ -0,0 +1,55 @@
+"""
+Processing bootstrap for the plugin: the native algorithms provider is registered (or found)
+once when the plugin loads, and the algorithms the pipeline runs are looked up once and kept.
+"""
+import threading
+from qgis.core import QgsApplication, QgsProcessingException
+from qgis.analysis import QgsNativeAlgorithms
+
+NATIVE_PROVIDER_ID = 'native'
+JOIN_BY_LOCATION_ALGORITHM = 'native:joinattributesbylocation'
+
+# The provider instance added by the plugin (None when QGIS already had one) and the looked up algorithms
+registered_provider = None
+algorithm_cache = {}
+registry_lock = threading.Lock()
+
+def ensure_native_algorithms():
+    """Register the native algorithms provider unless the processing registry already holds it."""
+    global registered_provider
+    registry = QgsApplication.processingRegistry()
+    with registry_lock:
+        if registry.providerById(NATIVE_PROVIDER_ID) is None:
+            provider = QgsNativeAlgorithms()
+            if registry.addProvider(provider):
+                registered_provider = provider
+        return registry.providerById(NATIVE_PROVIDER_ID)
+
+def processing_algorithm(algorithm_id):
+    """Return the registered algorithm with the given id, looked up in the registry only the first time."""
+    with registry_lock:
+        algorithm = algorithm_cache.get(algorithm_id)
+    if algorithm is not None:
+        return algorithm
+
+    ensure_native_algorithms()
+    algorithm = QgsApplication.processingRegistry().algorithmById(algorithm_id)
+    if algorithm is None:
+        raise ValueError(f"Processing algorithm '{algorithm_id}' is not available.")
+    with registry_lock:
+        algorithm_cache[algorithm_id] = algorithm
+    return algorithm
+
+def check_canceled(feedback):
+    """Stop the running work with a QgsProcessingException when the feedback was canceled."""
+    if feedback is not None and feedback.isCanceled():
+        raise QgsProcessingException("Canceled")
+
+def release_native_algorithms():
+    """Forget the cached algorithms and remove the provider, if it was added by the plugin."""
+    global registered_provider
+    with registry_lock:
+        algorithm_cache.clear()
+        if registered_provider is not None:
+            QgsApplication.processingRegistry().removeProvider(registered_provider)
+            registered_provider = None
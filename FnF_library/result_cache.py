@@ -0,0 +1,146 @@
+"""
+Persistent cache of Grid_Combined results.
+
+A result is stored as a GeoPackage in the QGIS profile, named by a hash of the fingerprints of the
+input layers and the settings of the run. Layers are fingerprinted by their source, subset string,
+feature count and the modification time and size of their file, without reading their features.
+Runs on layers without a file (memory layers such as a generated grid) are not cached. The least
+recently used results are removed once the cache outgrows its size.
+"""
+import glob
+import hashlib
+import json
+import os
+from qgis.core import (
+    QgsApplication,
+    QgsProviderRegistry,
+    QgsVectorFileWriter,
+    QgsVectorLayer,
+    QgsFeatureRequest,
+    QgsCoordinateTransformContext,
+    QgsMessageLog,
+    Qgis,
+)
+
+RESULT_CACHE_VERSION = 2  # Bump when the pipeline gives a different result for the same inputs
+RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3  # Least recently used results are removed above 2 GB
+RESULT_LAYER_NAME = 'Grid_Combined'
+
+def result_cache_dir():
+    """Return the directory of the result cache in the QGIS profile."""
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), 'FnF_plugin', 'result_cache')
+
+def layer_file_path(layer):
+    """Return the file behind a layer, or None for layers without one (memory, database)."""
+    path = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source()).get('path')
+    return path if path and os.path.isfile(path) else None
+
+def file_state(path):
+    """Return the modification time and size of a file and of its SQLite write-ahead log, if any."""
+    state = []
+    for candidate in (path, path + '-wal'):
+        if os.path.exists(candidate):
+            stat = os.stat(candidate)
+            state.append([os.path.basename(candidate), stat.st_mtime_ns, stat.st_size])
+    return state
+
+def layer_cache_fingerprint(layer):
+    """
+    Fingerprint a layer for the result cache. Returns None for layers with unsaved edits and for
+    layers without a file, whose content could only be fingerprinted by reading all features.
+    """
+    if layer.isModified():
+        return None
+    path = layer_file_path(layer)
+    if path is None:
+        return None
+    return {
+        'provider': layer.providerType(),
+        'source': layer.source(),
+        'subset': layer.subsetString(),
+        'count': layer.featureCount(),
+        'file': file_state(path),
+    }
+
+def result_cache_key(layers, settings):
+    """
+    Return the cache key of a run on the given layers (None for an absent layer) with the given
+    settings, or None when one of the layers cannot be fingerprinted.
+    """
+    fingerprints = []
+    for layer in layers:
+        if layer is None:
+            fingerprints.append(None)
+            continue
+        fingerprint = layer_cache_fingerprint(layer)
+        if fingerprint is None:
+            return None
+        fingerprints.append(fingerprint)
+    payload = json.dumps(
+        {'version': RESULT_CACHE_VERSION, 'layers': fingerprints, 'settings': settings},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def cached_result_path(key):
+    """Return the path of the GeoPackage holding the result for a cache key."""
+    return os.path.join(result_cache_dir(), f'{key}.gpkg')
+
+def load_cached_result(key):
+    """Return a memory copy of the cached result for a cache key, or None when it is not cached."""
+    path = cached_result_path(key)
+    if not os.path.exists(path):
+        return None
+    cached = QgsVectorLayer(f'{path}|layername={RESULT_LAYER_NAME}', RESULT_LAYER_NAME, 'ogr')
+    if not cached.isValid():
+        return None
+    # Edits to the result must not change the cache
+    layer = cached.materialize(QgsFeatureRequest())
+    layer.setName(RESULT_LAYER_NAME)
+    del cached
+    # The modification time orders the results for eviction
+    os.utime(path)
+    return layer
+
+def store_result(key, layer, max_bytes=RESULT_CACHE_MAX_BYTES):
+    """Store a result layer under a cache key and evict the least recently used results."""
+    os.makedirs(result_cache_dir(), exist_ok=True)
+    path = cached_result_path(key)
+    temp_path = f'{path}.partial.gpkg'
+
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'GPKG'
+    options.layerName = RESULT_LAYER_NAME
+    error = QgsVectorFileWriter.writeAsVectorFormatV3(layer, temp_path, QgsCoordinateTransformContext(), options)
+    if error[0] != QgsVectorFileWriter.NoError:
+        QgsMessageLog.logMessage(f"Result not cached: {error[1]}", level=Qgis.Warning)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+    # Readers never see a half written result
+    os.replace(temp_path, path)
+    evict_results(max_bytes)
+    return True
+
+def evict_results(max_bytes=RESULT_CACHE_MAX_BYTES):
+    """Remove the least recently used results until the cache fits in max_bytes; the newest is kept."""
+    entries = []
+    for path in glob.glob(os.path.join(result_cache_dir(), '*.gpkg')):
+        if path.endswith('.partial.gpkg'):
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries[:-1]:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            # Still opened by a layer in the project
+            pass
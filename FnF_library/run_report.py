@@ -0,0 +1,247 @@
+"""
+Instrumentation of the toets pipeline.
+
+A RunReport records the wall time, row counts and memory of every stage of a run, also when the
+stages run per tile in several threads, and writes them as a JSON run report next to a summary in the
+QGIS message log. The memory of a stage is the resident set size of the process at its start and end
+and the difference; stages running at the same time in other threads add to the same difference.
+The peak of the process is recorded as well, but in a long QGIS session it is often reached before
+the run. With profile the blocks run in profiled() are profiled with cProfile and the profiles are
+merged into one .prof file, which can be read with pstats or snakeviz. Only the newest
+RUN_REPORT_MAX_COUNT reports are kept.
+"""
+import cProfile
+import ctypes
+import datetime
+import glob
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from qgis.core import QgsApplication, QgsMessageLog, Qgis
+
+RUN_REPORT_MAX_COUNT = 100  # Older run reports (and their profiles) are removed
+# Memory fields of the records and stages, which are not summed as counts
+MEMORY_KEYS = ('rss_start_bytes', 'rss_end_bytes', 'rss_delta_bytes', 'max_rss_bytes', 'peak_rss_bytes')
+
+def run_report_dir():
+    """Return the directory of the run reports in the QGIS profile."""
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), 'FnF_plugin', 'run_reports')
+
+def windows_memory_counters():
+    """Return the memory counters of this process on Windows, or None when they cannot be read."""
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ('cb', wintypes.DWORD),
+            ('PageFaultCount', wintypes.DWORD),
+            ('PeakWorkingSetSize', ctypes.c_size_t),
+            ('WorkingSetSize', ctypes.c_size_t),
+            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+            ('PagefileUsage', ctypes.c_size_t),
+            ('PeakPagefileUsage', ctypes.c_size_t),
+        ]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters
+
+def peak_rss_bytes():
+    """Return the peak resident set size of this process in bytes, or None when it is not known."""
+    if sys.platform == 'win32':
+        counters = windows_memory_counters()
+        return counters.PeakWorkingSetSize if counters is not None else None
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def current_rss_bytes():
+    """Return the current resident set size of this process in bytes, or None when it is not known."""
+    if sys.platform == 'win32':
+        counters = windows_memory_counters()
+        return counters.WorkingSetSize if counters is not None else None
+
+    try:
+        # The second field of statm is the number of resident pages (Linux)
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+def memory_difference(start, end):
+    """Return end - start, or None when one of them is not known."""
+    return end - start if start is not None and end is not None else None
+
+def evict_reports(report_dir, max_count=RUN_REPORT_MAX_COUNT):
+    """Remove the oldest run reports, and their profiles, until at most max_count are left."""
+    reports = sorted(glob.glob(os.path.join(report_dir, '*.json')), key=os.path.getmtime)
+    for report_path in reports[:max(0, len(reports) - max_count)]:
+        for path in (report_path, os.path.splitext(report_path)[0] + '.prof'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class RunReport:
+    """Per-stage timings, counts and memory of one run."""
+    def __init__(self, name, profile=False, details=None):
+        self.name = name
+        self.details = details or {}
+        self.started_at = datetime.datetime.now()
+        self.start = time.perf_counter()
+        self.start_rss = current_rss_bytes()
+        self.start_peak_rss = peak_rss_bytes()
+        self.records = []
+        self.profiles = []
+        self.profile = profile
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **counts):
+        """
+        Time a stage. Yields a dict in which the stage can put its row counts; counts given here
+        (such as input feature counts) are recorded as well.
+        """
+        start = time.perf_counter()
+        start_rss = current_rss_bytes()
+        try:
+            yield counts
+        finally:
+            end = time.perf_counter()
+            end_rss = current_rss_bytes()
+            record = {
+                'stage': name,
+                'thread': threading.current_thread().name,
+                'start': round(start - self.start, 4),
+                'seconds': round(end - start, 4),
+                'rss_start_bytes': start_rss,
+                'rss_end_bytes': end_rss,
+                'rss_delta_bytes': memory_difference(start_rss, end_rss),
+                'peak_rss_bytes': peak_rss_bytes(),
+            }
+            record.update(counts)
+            with self.lock:
+                self.records.append(record)
+
+    @contextmanager
+    def profiled(self):
+        """Profile the code run in the block with cProfile when profiling is on."""
+        if not self.profile:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self.lock:
+                self.profiles.append(profiler)
+
+    def summary(self):
+        """
+        Aggregate the records per stage, in order of first start: the number of calls, the summed
+        time of all calls, the wall time from the first start to the last end, the summed counts,
+        the summed memory difference and the highest resident and peak memory at the end of a call.
+        """
+        with self.lock:
+            records = list(self.records)
+        stages = {}
+        for record in sorted(records, key=lambda record: record['start']):
+            stage = stages.setdefault(record['stage'], {
+                'stage': record['stage'], 'calls': 0, 'seconds': 0.0,
+                'first_start': record['start'], 'last_end': 0.0,
+                'rss_delta_bytes': None, 'max_rss_bytes': None, 'peak_rss_bytes': None,
+            })
+            stage['calls'] += 1
+            stage['seconds'] += record['seconds']
+            stage['last_end'] = max(stage['last_end'], record['start'] + record['seconds'])
+            if record['rss_delta_bytes'] is not None:
+                stage['rss_delta_bytes'] = (stage['rss_delta_bytes'] or 0) + record['rss_delta_bytes']
+            if record['rss_end_bytes'] is not None:
+                stage['max_rss_bytes'] = max(stage['max_rss_bytes'] or 0, record['rss_end_bytes'])
+            if record['peak_rss_bytes'] is not None:
+                stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'] or 0, record['peak_rss_bytes'])
+            for key, value in record.items():
+                if key not in MEMORY_KEYS + ('stage', 'thread', 'start', 'seconds') and isinstance(value, (int, float)):
+                    stage[key] = stage.get(key, 0) + value
+        for stage in stages.values():
+            stage['seconds'] = round(stage['seconds'], 4)
+            stage['wall_seconds'] = round(stage.pop('last_end') - stage.pop('first_start'), 4)
+        return list(stages.values())
+
+    def finish(self, status, report_dir=None):
+        """Write the JSON run report (and the merged profile) and log a summary. Returns the report path."""
+        report_dir = report_dir or run_report_dir()
+        os.makedirs(report_dir, exist_ok=True)
+        base_name = f"{self.name}_{self.started_at.strftime('%Y%m%d_%H%M%S_%f')}"
+        total_seconds = round(time.perf_counter() - self.start, 4)
+        summary = self.summary()
+
+        report = {
+            'name': self.name,
+            'status': status,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'total_seconds': total_seconds,
+            'start_rss_bytes': self.start_rss,
+            'end_rss_bytes': current_rss_bytes(),
+            'start_peak_rss_bytes': self.start_peak_rss,
+            'end_peak_rss_bytes': peak_rss_bytes(),
+            'details': self.details,
+            'stages': summary,
+            'records': self.records,
+        }
+
+        if self.profiles:
+            profile_path = os.path.join(report_dir, f'{base_name}.prof')
+            stats = pstats.Stats(self.profiles[0])
+            for profiler in self.profiles[1:]:
+                stats.add(profiler)
+            stats.dump_stats(profile_path)
+            report['profile'] = profile_path
+
+        report_path = os.path.join(report_dir, f'{base_name}.json')
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, default=str)
+        evict_reports(report_dir)
+
+        lines = [f"{self.name} {status} in {total_seconds:.1f} s, report: {report_path}"]
+        for stage in summary:
+            memory_text = ""
+            if stage['rss_delta_bytes'] is not None:
+                memory_text += f", memory {stage['rss_delta_bytes'] / 1024 ** 2:+.0f} MB"
+            if stage['max_rss_bytes'] is not None:
+                memory_text += f" to {stage['max_rss_bytes'] / 1024 ** 2:.0f} MB"
+            if stage['peak_rss_bytes'] is not None:
+                memory_text += f", process peak {stage['peak_rss_bytes'] / 1024 ** 2:.0f} MB"
+            counts = ", ".join(
+                f"{key} {value}" for key, value in stage.items()
+                if key not in MEMORY_KEYS + ('stage', 'calls', 'seconds', 'wall_seconds')
+            )
+            lines.append(
+                f"  {stage['stage']}: {stage['wall_seconds']:.2f} s wall, {stage['seconds']:.2f} s in "
+                f"{stage['calls']} calls{memory_text}" + (f", {counts}" if counts else "")
+            )
+        QgsMessageLog.logMessage("\n".join(lines), level=Qgis.Info)
+        return report_path
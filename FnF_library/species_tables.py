@@ -0,0 +1,154 @@
+import os
+import pickle
+import threading
+import pandas as pd
+from qgis.core import QgsMessageLog, Qgis
+
+RELATION_TABLES_DIR = os.path.join(os.path.dirname(__file__), 'relation_tables')
+BIJ12_SPECIES_FILE = os.path.join(RELATION_TABLES_DIR, 'bij12_kwalificerendesoorten_fix.csv')
+BIJ12_SPECIES_XLSX = os.path.join(RELATION_TABLES_DIR, 'Bij12_Kwalificerende_soorten_per_beheertype.xlsx')
+NDFF_SPECIES_FILE = os.path.join(RELATION_TABLES_DIR, 'soortenlijst_NDFF.csv')
+NDFF_SPECIES_DELIMITER = ';'
+# Optional quality class limits per beheertype: Beheertype, kwaliteit, minimum_soorten
+KWALITEIT_KLASSEN_FILE = os.path.join(RELATION_TABLES_DIR, 'kwaliteitsklassen_per_beheertype.csv')
+
+# Compact on-disk copy of the Bij12 table with only the columns the pipeline uses, as categoricals
+BIJ12_CACHE_FILE = os.path.join(RELATION_TABLES_DIR, 'bij12_kwalificerendesoorten.cache.pkl')
+BIJ12_CACHE_COLUMNS = ['Beheertype', 'ned_naam', 'ned_soortgroep']
+
+# Parsed relation tables and the views built on them, per file path
+table_cache = {}
+cache_lock = threading.RLock()
+
+def file_signature(paths):
+    """Return the modification time and size of the existing files, to detect changes."""
+    signature = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.append((os.path.basename(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+def cached_table(key, signature, load_table):
+    """Return the cached table for key, loading it again when its signature changed."""
+    with cache_lock:
+        entry = table_cache.get(key)
+        if entry is None or entry['signature'] != signature:
+            entry = {'signature': signature, 'table': load_table(), 'views': {}}
+            table_cache[key] = entry
+        return entry
+
+def load_relation_table(path=BIJ12_SPECIES_FILE, delimiter=','):
+    """
+    Read a relation table CSV once per session. The table is read again when the modification
+    time of the file changes. The returned DataFrame is shared and should not be modified.
+    """
+    entry = cached_table(path, file_signature([path]), lambda: pd.read_csv(path, delimiter=delimiter))
+    return entry['table']
+
+def read_compact_bij12_table(signature):
+    """
+    Read the used Bij12 columns from the on-disk cache, or from the CSV when the cache is missing
+    or was built from another version of the CSV, xlsx or pandas. A fresh cache is written next
+    to the relation tables; if that is not possible the table is only kept in memory.
+    """
+    signature = signature + (('pandas', pd.__version__),)
+    try:
+        with open(BIJ12_CACHE_FILE, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['signature'] == signature and cached['columns'] == BIJ12_CACHE_COLUMNS:
+            return cached['table']
+    except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError, AttributeError, ImportError):
+        pass
+
+    table = pd.read_csv(BIJ12_SPECIES_FILE, usecols=BIJ12_CACHE_COLUMNS).astype('category')
+    temp_file = f"{BIJ12_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, 'wb') as f:
+            pickle.dump(
+                {'signature': signature, 'columns': BIJ12_CACHE_COLUMNS, 'table': table},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(temp_file, BIJ12_CACHE_FILE)
+    except OSError as e:
+        QgsMessageLog.logMessage(f"Could not write species cache: {e}", level=Qgis.Warning)
+    return table
+
+def load_compact_bij12_table():
+    """Load the Bij12 columns used by the pipeline, cached in memory and on disk."""
+    signature = file_signature([BIJ12_SPECIES_FILE, BIJ12_SPECIES_XLSX])
+    return cached_table('bij12_compact', signature, lambda: read_compact_bij12_table(signature))
+
+def relation_table_view(path, delimiter, view_name, build_view):
+    """Return a view built from a relation table, cached until the table is read again."""
+    with cache_lock:
+        if path == BIJ12_SPECIES_FILE:
+            entry = load_compact_bij12_table()
+        else:
+            entry = cached_table(path, file_signature([path]), lambda: pd.read_csv(path, delimiter=delimiter))
+        views = entry['views']
+        if view_name not in views:
+            views[view_name] = build_view(entry['table'])
+        return views[view_name]
+
+def clear_cache():
+    """Forget all cached relation tables and views."""
+    with cache_lock:
+        table_cache.clear()
+
+def named_species(table):
+    """
+    Return the rows with a species name, with those of the used columns the table has as plain objects
+    and a lower-cased name added. The NDFF list has no Beheertype column, the Bij12 table has all of them.
+    """
+    table = table.dropna(subset=['ned_naam'])
+    table = table[table.columns.intersection(BIJ12_CACHE_COLUMNS)].astype(object)
+    return table.assign(naam_lower=table['ned_naam'].str.lower())
+
+def build_species_by_name(table):
+    """Build the species name view of a species table."""
+    species = named_species(table)
+    soortgroepen = species.drop_duplicates('naam_lower').set_index('naam_lower')['ned_soortgroep']
+    beheertypes = species.groupby('naam_lower')['Beheertype'].agg(lambda x: frozenset(x.dropna()))
+    return {
+        name: {'soortgroep': soortgroepen[name], 'beheertypes': beheertypes[name]}
+        for name in soortgroepen.index
+    }
+
+def build_species_by_beheertype(table):
+    """Build the beheertype view of a species table."""
+    species = named_species(table).dropna(subset=['Beheertype'])
+    return {
+        beheertype: frozenset(names)
+        for beheertype, names in species.groupby('Beheertype')['naam_lower']
+    }
+
+def build_species_by_soortgroep(table):
+    """Build the soortgroep view of a species table."""
+    species = named_species(table).dropna(subset=['ned_soortgroep'])
+    return {
+        soortgroep: frozenset(names)
+        for soortgroep, names in species.groupby('ned_soortgroep')['naam_lower']
+    }
+
+def species_by_name(path=BIJ12_SPECIES_FILE):
+    """Lower-cased species name -> {'soortgroep': ned_soortgroep, 'beheertypes': frozenset of Beheertype}."""
+    return relation_table_view(path, ',', 'by_name', build_species_by_name)
+
+def species_by_beheertype(path=BIJ12_SPECIES_FILE):
+    """Beheertype -> frozenset of lower-cased qualifying species names."""
+    return relation_table_view(path, ',', 'by_beheertype', build_species_by_beheertype)
+
+def species_by_soortgroep(path=BIJ12_SPECIES_FILE, delimiter=','):
+    """Soortgroep -> frozenset of lower-cased species names."""
+    return relation_table_view(path, delimiter, 'by_soortgroep', build_species_by_soortgroep)
+
+def ndff_species_by_soortgroep():
+    """
+    Soortgroep -> frozenset of lower-cased species names from the NDFF species list.
+    Without the NDFF list the soortgroepen of the Bij12 table (taken from the NDFF) are used.
+    """
+    if not os.path.exists(NDFF_SPECIES_FILE):
+        return species_by_soortgroep()
+    return species_by_soortgroep(NDFF_SPECIES_FILE, NDFF_SPECIES_DELIMITER)
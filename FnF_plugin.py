@@ -26,6 +26,8 @@ from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtWidgets import QAction
 from .resources import *
 from .FnF_plugin_dockwidget import FnF_pluginDockWidget
+from .FnF_library.processing_setup import ensure_native_algorithms, release_native_algorithms
+from .FnF_library.incremental_run import forget_all_runs
 import os.path
 
 class FnF_plugin:
@@ -93,6 +95,9 @@ class FnF_plugin:
 
     def initGui(self):
         """Create the menu entries and toolbar icons inside the QGIS GUI."""
+        # Register the processing algorithms once, not on every join
+        ensure_native_algorithms()
+
         icon_path = ':/plugins/FnF_plugin/icon/FnF_icon.png'
         self.add_action(
             icon_path,
@@ -113,6 +118,9 @@ class FnF_plugin:
                 action)
             self.iface.removeToolBarIcon(action)
         del self.toolbar
+        release_native_algorithms()
+        # The kept results listen to the edits of the layers, which outlive the plugin
+        forget_all_runs()
 
     def run(self):
         """Run method that loads and starts the plugin"""
@@ -6,7 +6,7 @@ from qgis.PyQt.QtCore import pyqtSignal, QVariant
 from qgis.utils import iface
 from .FnF_library.column_checker import check_columns, load_column_settings
 from .FnF_library.fnf_kwaliteitsbepaling import fnf_kwaliteitsbepaling
-from .FnF_library.create_ha_polygon_layer import get_bounding_box_from_selection, create_squares_from_bbox
+from .FnF_library.create_ha_polygon_layer import get_bounding_box_from_selection, create_squares_from_bbox, create_squares_from_polygons
 from PyQt5 import QtCore
 import datetime
 
@@ -131,11 +131,15 @@ class FnF_pluginDockWidget(QtWidgets.QDockWidget, FORM_CLASS):
             QtWidgets.QMessageBox.warning(self, "Warning", "Selected layer is not a valid polygon layer.")
             return
 
-        bbox = get_bounding_box_from_selection(layer)
-        if not bbox:
-            bbox = layer.extent()
+        if self.clipgrid.isChecked():
+            # Only create cells that intersect the selected (or all) polygons, plus one cell around them
+            grid_layer = create_squares_from_polygons(layer)
+        else:
+            bbox = get_bounding_box_from_selection(layer)
+            if not bbox:
+                bbox = layer.extent()
 
-        grid_layer = create_squares_from_bbox(bbox)
+            grid_layer = create_squares_from_bbox(bbox)
         QgsProject.instance().addMapLayer(grid_layer)
 
     def load_column_settings(self):
@@ -149,20 +153,39 @@ class FnF_pluginDockWidget(QtWidgets.QDockWidget, FORM_CLASS):
         polygon_layer_id = self.comboBoxPolygonLayer.currentData()
         point_layer_id = self.comboBoxPointData.currentData()
 
-        # Ensure all layers are selected
-        if not (grid_layer_id and polygon_layer_id and point_layer_id):
-            QtWidgets.QMessageBox.warning(self, "Warning", "Please select grid, polygon, and point layers.")
+        # Ensure the polygon and point layers are selected, the grid layer is optional
+        if not (polygon_layer_id and point_layer_id):
+            QtWidgets.QMessageBox.warning(self, "Warning", "Please select polygon and point layers.")
             return
 
-        # Retrieve the layers from their IDs
-        grid_layer = QgsProject.instance().mapLayer(grid_layer_id)
+        # Retrieve the layers from their IDs, without a grid layer the implicit grid is used
+        grid_layer = QgsProject.instance().mapLayer(grid_layer_id) if grid_layer_id else None
         polygon_layer = QgsProject.instance().mapLayer(polygon_layer_id)
         point_layer = QgsProject.instance().mapLayer(point_layer_id)
 
         # Ensure valid layers
-        if not (grid_layer and polygon_layer and point_layer):
+        if not (polygon_layer and point_layer) or (grid_layer_id and not grid_layer):
             QtWidgets.QMessageBox.warning(self, "Warning", "One or more selected layers are not valid.")
             return
 
+        # Read the year window for the observations
+        try:
+            begin_year = int(self.beginjaar.text())
+            end_year = int(self.totjaar.text())
+        except ValueError:
+            QtWidgets.QMessageBox.warning(self, "Warning", "Please enter a valid begin and end year.")
+            return
+        if begin_year > end_year:
+            QtWidgets.QMessageBox.warning(self, "Warning", "The begin year is after the end year.")
+            return
+
         # Run the external function, passing the actual layers
-        fnf_kwaliteitsbepaling(grid_layer, polygon_layer, point_layer)
+        # Repeated runs on the same layers only recompute the cells around the edits in between,
+        # runs on unchanged layers saved in files are loaded from the result cache
+        try:
+            fnf_kwaliteitsbepaling(
+                grid_layer, polygon_layer, point_layer, begin_year, end_year,
+                incremental=True, use_result_cache=True
+            )
+        except ValueError as e:
+            QtWidgets.QMessageBox.warning(self, "Warning", str(e))
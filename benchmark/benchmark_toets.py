@@ -0,0 +1,353 @@
+"""
+Headless benchmark of the toets pipeline.
+
+Scales the layers of test_data/test_data.gpkg synthetically to the requested numbers of points and
+grid cells, runs the kwaliteitsbepaling task on them without the GUI and reports the time and the
+throughput of every stage from the run report of the task.
+
+Run it with the Python of a QGIS installation, for example:
+
+    python benchmark/benchmark_toets.py --scenario 10000:1000 --scenario 1000000:100000 --output bench.json
+
+The synthetic GeoPackages are kept in the work directory and reused by later runs with the same
+scenario and seed.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DATA = os.path.join(REPO_DIR, 'test_data', 'test_data.gpkg')
+POLYGON_LAYER_NAME = 'beheergebied_copy_nbp_2024'
+POINT_LAYER_NAME = 'random_FnF_points'
+GRID_LAYER_NAME = 'grid'
+
+# Points and cells per scenario, from the size of the test data up to a large province
+DEFAULT_SCENARIOS = [(10000, 1000), (100000, 10000), (1000000, 100000), (5000000, 1000000)]
+MODES = ('implicit', 'grid', 'gpkg_sql', 'processing')
+DEFAULT_MODES = ('implicit', 'grid', 'gpkg_sql')
+WRITE_BATCH_SIZE = 100000  # Number of synthetic features written per batch
+
+def start_qgis():
+    """Start a QgsApplication without GUI, with the processing framework and the native algorithms."""
+    from qgis.core import QgsApplication
+
+    QgsApplication.setPrefixPath(os.environ.get('QGIS_PREFIX_PATH', sys.prefix), True)
+    app = QgsApplication([], False)
+    app.initQgis()
+
+    # The processing plugin ships with QGIS but is not on the path outside the application
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(), 'python', 'plugins'))
+    from processing.core.Processing import Processing
+    Processing.initialize()
+
+    sys.path.insert(0, REPO_DIR)
+    from FnF_library.processing_setup import ensure_native_algorithms
+    ensure_native_algorithms()
+    return app
+
+def open_layer(path, layer_name):
+    """Open a layer of a GeoPackage, raising when it cannot be read."""
+    from qgis.core import QgsVectorLayer
+
+    layer = QgsVectorLayer(f'{path}|layername={layer_name}', layer_name, 'ogr')
+    if not layer.isValid():
+        raise RuntimeError(f"Layer '{layer_name}' not found in {path}")
+    return layer
+
+def layer_writer(path, layer_name, fields, wkb_type, crs):
+    """Create a GeoPackage layer writer, adding the layer to the file when it already exists."""
+    from qgis.core import QgsVectorFileWriter, QgsCoordinateTransformContext
+
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'GPKG'
+    options.layerName = layer_name
+    if os.path.exists(path):
+        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
+    writer = QgsVectorFileWriter.create(path, fields, wkb_type, crs, QgsCoordinateTransformContext(), options)
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise RuntimeError(f"Cannot write '{layer_name}' to {path}: {writer.errorMessage()}")
+    return writer
+
+def data_fields(layer):
+    """Return the fields of a layer without its fid column, which the GeoPackage writer creates itself."""
+    from qgis.core import QgsFields
+
+    fields = QgsFields()
+    for field in layer.fields():
+        if field.name().lower() != 'fid':
+            fields.append(field)
+    return fields
+
+def data_attributes(feature, fields):
+    """Return the attributes of a feature for the given fields."""
+    return [feature[field.name()] for field in fields]
+
+def grid_shape(cells):
+    """Return the columns and rows of the most square grid with at least the given number of cells."""
+    columns = max(1, math.ceil(math.sqrt(cells)))
+    rows = max(1, math.ceil(cells / columns))
+    return columns, rows
+
+def write_grid(path, source_grid, x0, y0, columns, rows):
+    """Write a grid layer of columns x rows cells with its bottom-left corner at x0, y0."""
+    from qgis.core import QgsFeature, QgsGeometry
+    from FnF_library.create_ha_polygon_layer import CELL_SIZE, cell_ids, squares_to_wkb
+
+    fields = data_fields(source_grid)
+    writer = layer_writer(path, GRID_LAYER_NAME, fields, source_grid.wkbType(), source_grid.crs())
+    xs, ys = np.meshgrid(
+        x0 + np.arange(columns, dtype=np.int64) * CELL_SIZE,
+        y0 + np.arange(rows, dtype=np.int64) * CELL_SIZE,
+    )
+    xs, ys = xs.ravel(), ys.ravel()
+    for start in range(0, len(xs), WRITE_BATCH_SIZE):
+        chunk_xs = xs[start:start + WRITE_BATCH_SIZE]
+        chunk_ys = ys[start:start + WRITE_BATCH_SIZE]
+        features = []
+        for wkb, cell_id in zip(squares_to_wkb(chunk_xs, chunk_ys), cell_ids(chunk_xs, chunk_ys)):
+            geometry = QgsGeometry()
+            geometry.fromWkb(wkb)
+            feature = QgsFeature(fields)
+            feature.setGeometry(geometry)
+            feature['id'] = cell_id
+            features.append(feature)
+        writer.addFeatures(features)
+    del writer
+    return len(xs)
+
+def write_polygons(path, source_polygons, extent):
+    """Write copies of the source polygons, shifted side by side until they cover the extent."""
+    from qgis.core import QgsFeature, QgsGeometry
+
+    fields = data_fields(source_polygons)
+    writer = layer_writer(path, POLYGON_LAYER_NAME, fields, source_polygons.wkbType(), source_polygons.crs())
+    source_extent = source_polygons.extent()
+    width, height = source_extent.width(), source_extent.height()
+    sources = [
+        (feature.geometry(), data_attributes(feature, fields))
+        for feature in source_polygons.getFeatures() if feature.hasGeometry()
+    ]
+
+    count = 0
+    for i in range(max(1, math.ceil(extent.width() / width))):
+        for j in range(max(1, math.ceil(extent.height() / height))):
+            dx = extent.xMinimum() - source_extent.xMinimum() + i * width
+            dy = extent.yMinimum() - source_extent.yMinimum() + j * height
+            features = []
+            for geometry, attributes in sources:
+                shifted = QgsGeometry(geometry)
+                shifted.translate(dx, dy)
+                if not shifted.boundingBox().intersects(extent):
+                    continue
+                feature = QgsFeature(fields)
+                feature.setGeometry(shifted)
+                feature.setAttributes(attributes)
+                features.append(feature)
+            writer.addFeatures(features)
+            count += len(features)
+    del writer
+    return count
+
+def write_points(path, source_points, extent, points, rng):
+    """
+    Write points spread uniformly over the extent, each with the attributes (species, date)
+    of a random observation of the source points.
+    """
+    from qgis.core import QgsFeature, QgsGeometry, QgsPointXY
+
+    fields = data_fields(source_points)
+    writer = layer_writer(path, POINT_LAYER_NAME, fields, source_points.wkbType(), source_points.crs())
+    rows = [data_attributes(feature, fields) for feature in source_points.getFeatures()]
+    for start in range(0, points, WRITE_BATCH_SIZE):
+        size = min(WRITE_BATCH_SIZE, points - start)
+        xs = rng.uniform(extent.xMinimum(), extent.xMaximum(), size)
+        ys = rng.uniform(extent.yMinimum(), extent.yMaximum(), size)
+        picks = rng.integers(0, len(rows), size)
+        features = []
+        for x, y, pick in zip(xs.tolist(), ys.tolist(), picks.tolist()):
+            feature = QgsFeature(fields)
+            feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+            feature.setAttributes(rows[pick])
+            features.append(feature)
+        writer.addFeatures(features)
+    del writer
+    return points
+
+def synthetic_data(work_dir, points, cells, seed, regenerate=False):
+    """
+    Return the path of a GeoPackage with the test data scaled to the given number of points and
+    cells, creating it when it does not exist yet. The grid starts at the corner of the test grid.
+    """
+    from qgis.core import QgsRectangle
+    from FnF_library.create_ha_polygon_layer import CELL_SIZE
+
+    path = os.path.join(work_dir, f'synthetic_{points}_points_{cells}_cells_seed{seed}.gpkg')
+    if os.path.exists(path) and not regenerate:
+        return path
+    if os.path.exists(path):
+        os.remove(path)
+
+    source_grid = open_layer(TEST_DATA, GRID_LAYER_NAME)
+    source_polygons = open_layer(TEST_DATA, POLYGON_LAYER_NAME)
+    source_points = open_layer(TEST_DATA, POINT_LAYER_NAME)
+
+    columns, rows = grid_shape(cells)
+    x0 = math.floor(source_grid.extent().xMinimum() / CELL_SIZE) * CELL_SIZE
+    y0 = math.floor(source_grid.extent().yMinimum() / CELL_SIZE) * CELL_SIZE
+    extent = QgsRectangle(x0, y0, x0 + columns * CELL_SIZE, y0 + rows * CELL_SIZE)
+
+    start = time.perf_counter()
+    temp_path = f'{path}.partial.gpkg'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    write_grid(temp_path, source_grid, x0, y0, columns, rows)
+    write_polygons(temp_path, source_polygons, extent)
+    write_points(temp_path, source_points, extent, points, np.random.default_rng(seed))
+    os.replace(temp_path, path)
+    print(f"Created {os.path.basename(path)} in {time.perf_counter() - start:.1f} s", flush=True)
+    return path
+
+def run_mode(path, mode):
+    """Run the kwaliteitsbepaling task on the layers of a synthetic GeoPackage and return its run report."""
+    from qgis.core import QgsProject
+    from FnF_library.fnf_kwaliteitsbepaling import kwaliteitsbepaling_task, aggregation_rules, JoinAndProcessTask
+
+    grid_layer = open_layer(path, GRID_LAYER_NAME) if mode != 'implicit' else None
+    polygon_layer = open_layer(path, POLYGON_LAYER_NAME)
+    point_layer = open_layer(path, POINT_LAYER_NAME)
+    # The processing join reads the layers through the project, as they are when the plugin runs
+    layers = [layer for layer in (grid_layer, polygon_layer, point_layer) if layer is not None]
+    QgsProject.instance().addMapLayers(layers)
+
+    if mode == 'processing':
+        # The processing join handles the whole layers in one go, so the task is not tiled
+        polygon_rules, point_rules = aggregation_rules()
+        task = JoinAndProcessTask(
+            grid_layer, polygon_layer, point_layer, polygon_rules, point_rules, use_processing_join=True
+        )
+    else:
+        task = kwaliteitsbepaling_task(grid_layer, polygon_layer, point_layer, use_gpkg_sql=(mode == 'gpkg_sql'))
+
+    # The task runs in this thread, the task manager needs an event loop
+    start = time.perf_counter()
+    succeeded = task.run()
+    seconds = time.perf_counter() - start
+    QgsProject.instance().removeAllMapLayers()
+
+    return {
+        'succeeded': bool(succeeded),
+        'seconds': round(seconds, 4),
+        'details': task.report.details,
+        'stages': task.report.summary(),
+    }
+
+def throughput(stage, points, cells):
+    """Return the throughput of a stage: points per second for the point join, cells per second otherwise."""
+    seconds = stage['wall_seconds']
+    if seconds <= 0:
+        return None, None
+    if stage['stage'] == 'join points':
+        return points / seconds, 'points/s'
+    return cells / seconds, 'cells/s'
+
+def print_result(result):
+    """Print the timings and throughput of one benchmark run."""
+    points, cells = result['points'], result['cells']
+    status = 'ok' if result['succeeded'] else 'FAILED'
+    print(
+        f"\n{points} points, {cells} cells, {result['mode']}: {result['seconds']:.2f} s ({status}), "
+        f"{points / result['seconds']:,.0f} points/s, {cells / result['seconds']:,.0f} cells/s"
+    )
+    for stage in result['stages']:
+        rate, unit = throughput(stage, points, cells)
+        rate_text = f"{rate:>14,.0f} {unit}" if rate is not None else ''
+        print(f"  {stage['stage']:<20} {stage['wall_seconds']:>9.3f} s {stage['calls']:>5} calls {rate_text}")
+
+def parse_scenario(text):
+    """Parse a POINTS:CELLS scenario."""
+    try:
+        points, cells = (int(value) for value in text.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid scenario '{text}', expected POINTS:CELLS")
+    if points < 1 or cells < 1:
+        raise argparse.ArgumentTypeError(f"Invalid scenario '{text}', points and cells must be positive")
+    return points, cells
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--scenario', action='append', type=parse_scenario, metavar='POINTS:CELLS',
+        help="Number of points and grid cells, can be repeated (default: 10000:1000 up to 5000000:1000000)"
+    )
+    parser.add_argument(
+        '--mode', action='append', choices=MODES,
+        help="Join to benchmark, can be repeated (default: implicit, grid and gpkg_sql)"
+    )
+    parser.add_argument('--repeat', type=int, default=1, help="Number of runs per scenario and mode")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic points")
+    parser.add_argument(
+        '--work-dir', default=os.path.join(tempfile.gettempdir(), 'fnf_benchmark'),
+        help="Directory of the synthetic GeoPackages"
+    )
+    parser.add_argument('--regenerate', action='store_true', help="Recreate the synthetic GeoPackages")
+    parser.add_argument('--output', help="Write all results to this JSON file")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    scenarios = arguments.scenario or DEFAULT_SCENARIOS
+    modes = arguments.mode or list(DEFAULT_MODES)
+    os.makedirs(arguments.work_dir, exist_ok=True)
+
+    app = start_qgis()
+    from qgis.core import Qgis
+
+    results = []
+    for points, cells in scenarios:
+        path = synthetic_data(arguments.work_dir, points, cells, arguments.seed, arguments.regenerate)
+        columns, rows = grid_shape(cells)
+        for mode in modes:
+            for repeat in range(arguments.repeat):
+                result = {
+                    'scenario': [points, cells], 'points': points, 'cells': columns * rows,
+                    'mode': mode, 'repeat': repeat,
+                }
+                result.update(run_mode(path, mode))
+                print_result(result)
+                results.append(result)
+
+    if arguments.repeat > 1:
+        print("\nMedian of the repeated runs:")
+        for points, cells in scenarios:
+            for mode in modes:
+                seconds = [
+                    result['seconds'] for result in results
+                    if result['scenario'] == [points, cells] and result['mode'] == mode and result['succeeded']
+                ]
+                if seconds:
+                    print(f"  {points} points, {cells} cells, {mode}: {statistics.median(seconds):.2f} s")
+
+    if arguments.output:
+        with open(arguments.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'qgis_version': Qgis.QGIS_VERSION,
+                'python_version': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'results': results,
+            }, f, indent=2, default=str)
+
+    app.exitQgis()
+    return 0 if all(result['succeeded'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())